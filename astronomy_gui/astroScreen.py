@@ -1,28 +1,37 @@
 import os.path
 import platform
 import queue
-import threading
 import time
 import tkinter as tk
 import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import filedialog, messagebox, simpledialog
 
 from astropy.coordinates import EarthLocation
 from astropy.coordinates.errors import UnknownSiteException
 from astropy.coordinates.name_resolve import NameResolveError
 from astropy.time import Time
-from PIL import Image, ImageTk
-from PIL.Image import ANTIALIAS
+from PIL import ImageTk
 
 from astronomy_gui.controller import CONTROLLER
 from astronomy_gui.images import get_imagepath
 from astronomy_gui.page import Page
-from get_picture import get_sky_picture
-from planets import MAPPING_DICT, PLANET_COORDINATES, constant_planet_update
+from enhance import NO_ENHANCEMENT
+from ephemeris_scheduler import EphemerisScheduler
+from get_picture import is_sky_picture_on_disk, stop_using_tile_pack, use_tile_pack
+from mosaic_export import MAX_UNSTREAMED_TILES, MosaicExport, is_streamed
+from planets import MAPPING_DICT, PLANET_SNAPSHOTS
+from sky_grid import VIEW_OFFSETS, pan_view, snap_view, view_centre
+from tile_cache import TileMemoryCache
+from tile_fetcher import (CENTRE_PRIORITY, MOSAIC, VISIBLE_PRIORITY, MosaicJob,
+                          TileFetchEngine, TileJob, TilePrefetcher, ring_jobs,
+                          view_jobs)
+from tile_pyramid import TilePyramid
 from tools import (convert_altaz_to_radec, from_deg_rep, from_hour_rep,
                    get_constellation, get_coordinates_from_observer,
                    get_earth_location_coordinates, get_magnitude,
-                   get_object_coordinates, safe_put)
+                   get_object_coordinates)
 
 # True is the system is Linux, False otherwise
 LINUX = platform.system() == 'Linux'
@@ -33,21 +42,35 @@ if LINUX:
 # Initial save dir for different OSes
 SAVE_INITIAL_DIR = "%userprofile%\\Pictures" if platform.system() == "Windows" else "/home/pi/Pictures" if LINUX else os.path.expanduser("~/Pictures")
 
+# Number of threads resizing tiles for display and making stand-ins, so the Tk thread never waits for either
+RENDER_WORKERS = 2
+
+# Kinds of result handed to the Tk thread: a tile that has been fetched, a cached tile that has been
+# resized for display and a stand-in for a tile still being fetched
+FETCHED = 'fetched'
+RENDERED = 'rendered'
+STAND_IN = 'stand_in'
+
+# A result for the Tk thread, with the tile (None if it couldn't be got) and its display image made with some enhancement settings
+TileResult = namedtuple('TileResult', ['kind', 'generation', 'slot', 'job', 'tile', 'image', 'settings'])
+
 class AstroScreen(Page):
     """
     The class for an instance of Page that handlesall astronomy-type functions
     """
 
     # Pixel offsets for the pixel shifts of the 3x3 sky view
-    IMAGE_PIXEL_OFFSETS = [
-        (256, 256),  (0, 256),  (-256, 256),
-        (256, 0),    (0, 0),    (-256, 0),
-        (256, -256), (0, -256), (-256, -256)
-    ]
+    IMAGE_PIXEL_OFFSETS = VIEW_OFFSETS
 
     # The resolution (x and y) that each image is resized to (to fit)
     IMAGE_RESOLUTION = (135, 135)
 
+    # the loading gif is shrunk by this much to fit on a tile
+    LOADING_GIF_SUBSAMPLE = 2
+
+    # the most tiles across (and down) a saved mosaic can be
+    MAX_EXPORT_TILES = 50
+
     def __init__(self, parent):
         """
         Does the page setup for the astronomy screen
@@ -57,16 +80,19 @@ class AstroScreen(Page):
 
         self.latest_file_loc = ''
 
-        self.all_coords = []
+        # the mosaic being saved (only one at a time) and the window showing its progress
+        self.export = None
+        self.export_window = None
 
-        # The Pleiades
-        self.base_ra = from_hour_rep(3, 47, 24)
-        self.base_de = from_deg_rep(24, 7, 0)
-
-        self.shiftx = 0
-        self.shifty = 0
         self.magnification = 0.0
 
+        # how the tiles are enhanced for display (contrast, gamma and night vision)
+        self.enhancement = NO_ENHANCEMENT
+
+        # The Pleiades (snapped to the tile grid)
+        self.base_ra, self.base_de, self.shiftx, self.shifty = snap_view(from_hour_rep(3, 47, 24), from_deg_rep(24, 7, 0),
+                                                                         self.magnification)
+
         self.location = 'Greenwich'
         self.lat, self.long = get_earth_location_coordinates(self.location.lower())
         self.time = time.strftime("%Y-%m-%d %H:%M:%S")
@@ -76,33 +102,44 @@ class AstroScreen(Page):
         self.height = 480
         self.grid()
 
-        planet_update_process = threading.Thread(None, lambda: constant_planet_update(skip=True, screen=self))
-        planet_update_process.setDaemon(True)
-        planet_update_process.start()
+        # keeps the planet positions up to date on one background thread
+        self.planet_scheduler = EphemerisScheduler(self)
+        self.planet_scheduler.start()
 
         CONTROLLER.after(self.CHECK_FREQUENCY,
-                         lambda: self.check_thread(planet_update_process,
-                                                   lambda: self.display_info("Initial planet locations have been calculated", "Planet locations calculated")))
+                         lambda: self.check_planet_update(0, 0, lambda: self.display_info("Initial planet locations have been calculated",
+                                                                                       "Planet locations calculated")))
 
         #instruction label
         #instr_label = tk.Label(self, text="Please select a network to connect to:", font=("Helvetica", 34))
         #instr_label.grid(row=0, column=1, columnspan=3)
 
-        #loading things
-        load_image = tk.PhotoImage(file=self.loading_gif_path, format='gif -index 0')
-
-        self.load_label = tk.Label(self, image=load_image, borderwidth=0, highlightthickness=0)
-        self.load_label.image = load_image
-
-        self.load_label.grid(row=1, column=1)
-
-        self.image_label_list = [tk.Label(self, image=None, borderwidth=0, highlightthickness=0) for i in range(9)]
+        # fixed size, so that a loading gif on a tile still pending takes up the same space as the tile
+        self.image_label_list = [tk.Label(self, image=None, borderwidth=0, highlightthickness=0, background=self.background,
+                                          width=self.IMAGE_RESOLUTION[0], height=self.IMAGE_RESOLUTION[1]) for i in range(9)]
         for index, label in enumerate(self.image_label_list):
             row = (index // 3) + 1
             column = (index % 3) + 1
 
             label.grid(row=row, column=column)
             label.grid_remove()
+
+            # the key of the tile the label is showing, and the enhancement settings it's shown with
+            label.tile_key = None
+            label.tile_settings = None
+
+            # set while the label shows the loading gif, which stops when it changes
+            label.loading_token = None
+
+            # the label's own PhotoImage, which every tile shown on it is pasted into
+            label.photo = ImageTk.PhotoImage('RGB', self.IMAGE_RESOLUTION)
+
+            # a label without an image would take its width and height in characters rather than pixels
+            label.configure(image=label.photo)
+
+        # number of PhotoImages made since the labels were set up, and of images pasted into existing ones
+        self.photo_allocations = 0
+        self.photo_pastes = 0
         
         self.grid_rowconfigure(0, weight=1)
         self.grid_rowconfigure(4, weight=1)
@@ -113,13 +150,37 @@ class AstroScreen(Page):
 
         self._do_bindings()
 
-        self.image_cache = {}
+        self.image_cache = TileMemoryCache()
+
+        # tiles for the current view arrive here (as TileResults) from the fetch and render threads
+        self.tile_results = queue.Queue()
+        self.checking_tiles = False
 
-        CONTROLLER.after(self.LOADING_GIF_FREQUENCY, lambda: self.update_loading_gif(1, self.load_label, time.time()))
+        # cached tiles not yet resized for the current settings (and stand-ins) are made on these
+        self.render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
 
-        self.image_queue_list = [queue.Queue(1) for i in range(9)]
+        # slot -> (key, settings) of the resizes the current view is waiting for
+        self.render_pending = {}
 
-        #shiftx, shifty, new_base_ra=None, new_base_de=None, new_base_magnification=None, overwrite_cache=False
+        self.batch_generation = 0
+        self.batch_images = [None] * 9
+
+        # slots of the current view still being fetched, whether any of them couldn't be
+        # and whether the fetching has been finished off
+        self.batch_pending = set()
+        self.batch_failed = False
+        self.batch_finished = True
+
+        # how the current view is being fetched (None if some of it was cached) and when it started
+        self.batch_mode = None
+        self.batch_start = 0
+
+        self.pyramid = TilePyramid(self.image_cache)
+
+        self.fetch_engine = TileFetchEngine(self.tile_fetched)
+        self.prefetcher = TilePrefetcher(self.fetch_engine)
+
+        #shiftx, shifty, new_base_ra=None, new_base_de=None, new_base_magnification=None
 
         self.generate_batch_images(0, 0)
     
@@ -136,6 +197,10 @@ class AstroScreen(Page):
                             activebackground='#262626', activeforeground='white')
         file_menu.add_command(label="Save", command=self.save_image)
         file_menu.add_command(label="Save As", command=self.save_as_image)
+        file_menu.add_command(label="Save large mosaic", command=self.save_large_image)
+        file_menu.add_separator()
+        file_menu.add_command(label="Open tile pack", command=self.open_tile_pack)
+        file_menu.add_command(label="Stop using tile pack", command=self.close_tile_pack)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=CONTROLLER.destroy)
 
@@ -154,6 +219,7 @@ class AstroScreen(Page):
         astronomy_menu.add_cascade(label='Goto planet', menu=planet_goto_menu)
         astronomy_menu.add_cascade(label="Planet info", menu=planet_info_menu)
         astronomy_menu.add_command(label="Refresh planet positions", command=self.refresh_planets)
+        astronomy_menu.add_command(label="Planet update status", command=self.show_planet_status)
         astronomy_menu.add_separator()
         astronomy_menu.add_command(label="Goto object (By name)", command=self.show_object)
         astronomy_menu.add_command(label="Object info (By name)", command=self.show_object_info)
@@ -173,6 +239,10 @@ class AstroScreen(Page):
         settings_menu.add_command(label="Change coordinates (az/alt)", command=self.set_azalt_coordinates)
         settings_menu.add_command(label="Change location", command=self.set_location)
         settings_menu.add_command(label="Change time", command=self.set_time)
+        settings_menu.add_separator()
+        settings_menu.add_command(label="Night vision on/off", command=self.toggle_night_vision)
+        settings_menu.add_command(label="Change contrast", command=self.set_contrast)
+        settings_menu.add_command(label="Change gamma", command=self.set_gamma)
 
         # setting up the help submenu
         help_menu = tk.Menu(self.menubar, tearoff=0, font=("Helvetica", self.MENU_FONT_SIZE), background='black', foreground='white',
@@ -215,11 +285,56 @@ class AstroScreen(Page):
 
         if obstime is not None:
             if obstime.lower() == 'current':
-                self.update_time(time.strftime("%Y-%m-%d %H:%M:%S"))
-                self.time_manual = False
+                self.update_time(time.strftime("%Y-%m-%d %H:%M:%S"), manual=False)
             else:
                 self.update_time(obstime)
     
+    def toggle_night_vision(self):
+        """
+        Switches between showing the tiles normally and in red only (to keep dark adapted eyes dark adapted)
+        """
+        self.set_enhancement(self.enhancement._replace(night_vision=not self.enhancement.night_vision))
+
+    def set_contrast(self):
+        """
+        Sets the levels that are shown as black and as white, stretching the contrast of what's in between
+        """
+        black_point = simpledialog.askinteger("Enter new black level", "Please enter the level (0 - 254) at or below which the sky is shown black.\n" +
+                                              "The black level is currently {}".format(self.enhancement.black_point),
+                                              minvalue=0, maxvalue=254, parent=self)
+        if black_point is None:
+            return
+
+        white_point = simpledialog.askinteger("Enter new white level", "Please enter the level ({} - 255) at or above which the sky is shown white.\n".format(black_point + 1) +
+                                              "The white level is currently {}".format(self.enhancement.white_point),
+                                              minvalue=black_point + 1, maxvalue=255, parent=self)
+        if white_point is None:
+            return
+
+        self.set_enhancement(self.enhancement._replace(black_point=black_point, white_point=white_point))
+
+    def set_gamma(self):
+        """
+        Sets the gamma the tiles are shown with (above 1 brings out the faint stuff)
+        """
+        gamma = simpledialog.askfloat("Enter new gamma", "Please enter a new gamma (1 is normal, higher brings out faint objects).\n" +
+                                      "The gamma is currently {}".format(self.enhancement.gamma), minvalue=0.1, maxvalue=10, parent=self)
+
+        if gamma is not None:
+            self.set_enhancement(self.enhancement._replace(gamma=gamma))
+
+    def set_enhancement(self, settings):
+        """
+        Changes how the tiles are enhanced and shows the view again with it
+        (tiles already shown with some settings are kept, so switching back costs nothing).
+        The tiles not yet enhanced with the settings stay as they are until the render threads have done them
+        """
+        self.enhancement = settings
+
+        for index in range(9):
+            if self.batch_images[index] is not None:
+                self.show_tile(index)
+
     def set_magnification(self):
         """
         Sets the magnification to view different sizes
@@ -227,7 +342,7 @@ class AstroScreen(Page):
         new_mag = simpledialog.askfloat("Enter new magnification", "Please enter a new magnification (0 is the default, -1 is smaller and 1 is bigger.)\nThe magnification is currently {}".format(self.magnification), parent=self)
 
         if new_mag is not None:
-            self.generate_batch_images(0, 0, new_base_magnification=new_mag, overwrite_cache=True)
+            self.generate_batch_images(0, 0, new_base_magnification=new_mag)
 
     def show_sites(self):
         """
@@ -267,20 +382,68 @@ class AstroScreen(Page):
         """
         Refreshes the planet locations
         """
-        planet_process = threading.Thread(None, lambda: constant_planet_update(True, screen=self))
-        planet_process.start()
+        version = PLANET_SNAPSHOTS.version
+        failures = self.planet_scheduler.status()['failures']
+        self.planet_scheduler.replan()
 
         CONTROLLER.after(self.CHECK_FREQUENCY,
-                         lambda: self.check_thread(planet_process,
-                                                   lambda: self.display_info("Planet positions successfully updated", "Planets updated")))
+                         lambda: self.check_planet_update(version, failures, lambda: self.display_info("Planet positions successfully updated",
+                                                                                                       "Planets updated")))
+
+    def check_planet_update(self, version, failures, callback):
+        """
+        Checks if there are planet positions newer than a version, and if so, calls a callback.
+        Stops checking (telling the user why) if the scheduler has failed more than failures times
+        """
+        if PLANET_SNAPSHOTS.version > version:
+            callback()
+            return
+
+        status = self.planet_scheduler.status()
+
+        if status['failures'] > failures:
+            self.display_error("The planet positions could not be calculated ({}), they will be tried again in the background"
+                               .format(status['error']), "Planet update failed")
+        else:
+            CONTROLLER.after(self.CHECK_FREQUENCY, lambda: self.check_planet_update(version, failures, callback))
+
+    def show_planet_status(self):
+        """
+        Shows how the planet positions are being kept up to date
+        """
+        status = self.planet_scheduler.status()
+
+        if status['last_update'] is None:
+            last_update = "never"
+        else:
+            last_update = "{}s ago (took {}ms)".format(round(time.time() - status['last_update']),
+                                                     round(status['last_duration'] * 1000))
+
+        next_updates = ", ".join("{} {}".format(name, "-" if due is None else "{}s".format(round(due)))
+                                 for name, due in status['next_due'].items())
+
+        info_string = ("Running: {}\nUpdates: {}\nLast update: {}\nNext updates: {}".format(
+            "yes" if status['running'] else "no", status['updates'], last_update, next_updates))
+
+        if status['error'] is not None:
+            info_string += "\nLast error: {}".format(status['error'])
+
+        self.display_info(info_string, "Planet update status")
     
+    def update_planets(self):
+        """
+        Updates the planet locations for a new time or location straight away (in the background, as a new
+        location needs a new ephemeris table; any other time in the table's night is just an interpolation)
+        """
+        self.planet_scheduler.replan()
+
     def set_coordinates(self):
         """
         Sets the RA and DEC of the piece of the sky you are looking at
         """
         coordinate_string = simpledialog.askstring("Enter new coordinates", "Please enter new coordinates.\nThe formats \"(hours, minutes, seconds), (degrees, arcmins, arcsecs)\"\n" +
                                                    "and \"hours, degrees\" (where the latter takes values with decimal points) are both acceptable." +
-                                                   "\nThe current values are: {} hours, {} degrees".format(round(self.base_ra, 2), round(self.base_de, 2)), parent=self)
+                                                   "\nThe current values are: {} hours, {} degrees".format(*(round(value, 2) for value in self.current_centre())), parent=self)
         
         if coordinate_string is None:
             return
@@ -321,7 +484,7 @@ class AstroScreen(Page):
                                "and declination in the range -90 - 90", "Invalid input")
             return
 
-        self.generate_batch_images(0, 0, righta, dec, overwrite_cache=True)
+        self.generate_batch_images(0, 0, righta, dec)
     
     def set_azalt_coordinates(self):
         """
@@ -330,7 +493,7 @@ class AstroScreen(Page):
         if not self.time_manual:
             self.time = time.strftime("%Y-%m-%d %H:%M:%S")
 
-        old_az, old_alt = get_coordinates_from_observer(self.base_ra, self.base_de, self.location, self.time)
+        old_az, old_alt = get_coordinates_from_observer(*self.current_centre(), self.location, self.time)
 
         coordinate_string = simpledialog.askstring("Enter new coordinates", "Please enter new coordinates.\nThe formats \"(az_degrees, az_arcmins, az_arcsecs), (alt_degrees, alt_arcmins, alt_arcsecs)\"\n" +
                                                    "and \"az_degrees, alt_degrees\" (where the latter takes values with decimal points) are both acceptable." +
@@ -377,7 +540,7 @@ class AstroScreen(Page):
 
         righta, dec = convert_altaz_to_radec(az, alt, self.location, self.time)
 
-        self.generate_batch_images(0, 0, righta, dec, overwrite_cache=True)
+        self.generate_batch_images(0, 0, righta, dec)
 
     def display_image(self, all_cached=False):
         """
@@ -385,99 +548,389 @@ class AstroScreen(Page):
         """
         print("Pics done")
 
-        self.load_label.grid_remove()
-
         for index in range(9):
-            starttime = time.time()
+            self.show_tile(index)
+
+    def show_tile(self, index):
+        """
+        Shows the tile of the current view that belongs on a label
+        """
+        tile, job = self.batch_images[index]
+        label = self.image_label_list[index]
+
+        # the label is already showing this tile, so there's nothing to redo
+        if label.tile_key == job.key and label.tile_settings == self.enhancement:
+            label.grid()
+            return
+
+        # resized (and enhanced) once per tile and settings, then reused from the cache on every redraw
+        image = self.image_cache.cached_rendition(job.key, self.IMAGE_RESOLUTION, self.enhancement)
 
-            while True and time.time() - starttime < 1:
-                try:
-                    image, shiftx, shifty = self.image_queue_list[index].get(block=False)
-                    break
-                except queue.Empty:
-                    if all_cached:
-                        return
-                    continue
+        if image is not None:
+            self.show_on_label(index, image, job.key, self.enhancement)
+            return
+
+        # a label showing the tile with other settings keeps it until the new one is ready
+        if label.tile_key != job.key and label.loading_token != self.batch_generation:
+            self.show_loading(index)
+
+        self.request_render(index)
+
+    def request_render(self, index):
+        """
+        Has a tile of the current view resized for display with the current settings on a render thread
+        """
+        tile, job = self.batch_images[index]
+        settings = self.enhancement
+
+        if self.render_pending.get(index) == (job.key, settings):
+            return
+
+        self.render_pending[index] = (job.key, settings)
+        self.render_executor.submit(self.render_tile, self.batch_generation, index, job, tile, settings)
+
+        self.start_checking()
+
+    def render_tile(self, generation, slot, job, tile, settings):
+        """
+        Runs on a render thread, resizing a tile for display and handing it to the Tk thread
+        """
+        try:
+            image = self.image_cache.rendition(job.key, self.IMAGE_RESOLUTION, tile, settings)
+        except Exception as error:
+            print("Tile {} could not be shown: {!r}".format(job, error))
+            image = None
+
+        self.tile_results.put(TileResult(RENDERED, generation, slot, job, tile, image, settings))
+
+    def render_stand_in(self, generation, slot, job, settings):
+        """
+        Runs on a render thread, making a stand-in for a tile out of the tiles cached at other magnifications
+        and handing it to the Tk thread (if there is one)
+        """
+        try:
+            image = self.pyramid.placeholder(job, self.IMAGE_RESOLUTION, settings)
+        except Exception as error:
+            print("No stand-in for {}: {!r}".format(job, error))
+            image = None
+
+        if image is not None:
+            self.tile_results.put(TileResult(STAND_IN, generation, slot, job, None, image, settings))
+
+    def shift_tiles(self):
+        """
+        Moves the tiles already on screen to the labels they belong on in the current view,
+        so after a pan only the newly exposed row or column has to be rendered
+        """
+        on_screen = {label.tile_key: (label.photo, label.tile_settings) for label in self.image_label_list if label.tile_key is not None}
+
+        # index -> (PhotoImage it takes over, settings it was shown with)
+        moves = {}
+
+        for index, label in enumerate(self.image_label_list):
+            if self.batch_images[index] is None:
+                continue
+
+            key = self.batch_images[index][1].key
+
+            if label.tile_key != key and key in on_screen:
+                moves[index] = on_screen[key]
+
+        if not moves:
+            return
+
+        # the PhotoImages are swapped round between the labels, so none are made and nothing is resized or copied:
+        # labels whose tile moved away get the PhotoImages of the labels that took over another one
+        taken = set(id(photo) for photo, _ in moves.values())
+
+        freed = [self.image_label_list[index].photo for index in moves if not id(self.image_label_list[index].photo) in taken]
+        robbed = [index for index, label in enumerate(self.image_label_list) if not index in moves and id(label.photo) in taken]
+
+        for index, (photo, settings) in moves.items():
+            label = self.image_label_list[index]
+
+            label.photo = photo
+            label.configure(image=photo)
+            label.image = photo
+            label.tile_key = self.batch_images[index][1].key
+            label.tile_settings = settings
+            label.loading_token = None
+
+            label.grid()
+
+        for index, photo in zip(robbed, freed):
+            label = self.image_label_list[index]
+
+            # shown again (or given the loading gif) straight after this
+            label.photo = photo
+            label.tile_key = None
+
+    def show_loading(self, index):
+        """
+        Shows the loading gif on the label of a tile that is still pending
+        """
+        label = self.image_label_list[index]
+
+        # a gif still running on the label from an earlier view stops, as its token no longer matches
+        token = self.batch_generation
+
+        label.loading_token = token
+        label.tile_key = None
+
+        # the first frame goes on straight away, so the label never appears with the last tile it showed
+        self.update_loading_gif(0, label, time.time(), token, self.LOADING_GIF_SUBSAMPLE)
+
+        label.grid()
+
+    def show_on_label(self, index, display_image, key=None, settings=None):
+        """
+        Shows an image (already at the display resolution) on one of the labels,
+        key being the tile it is (None for stand-ins) and settings what it's enhanced with
+        """
+        label = self.image_label_list[index]
+
+        if display_image.size == (label.photo.width(), label.photo.height()):
+            label.photo.paste(display_image)
+            self.photo_pastes += 1
+        else:
+            label.photo = ImageTk.PhotoImage(display_image)
+            self.photo_allocations += 1
+
+        label.configure(image=label.photo)
+        label.image = label.photo
+        label.tile_key = key
+        label.tile_settings = settings
+        label.loading_token = None
+
+        label.grid()
+    
+    def tile_fetched(self, generation, slot, job, tile):
+        """
+        Runs on a fetch thread when a tile arrives, caching it (resized for display, so the Tk thread
+        only has to put it on a label) and passing visible ones to the Tk thread
+        """
+        settings = self.enhancement
+        image = None
+
+        if tile is not None:
+            self.store_tile(job, tile)
+
+            try:
+                image = self.image_cache.rendition(job.key, self.IMAGE_RESOLUTION, tile, settings)
+            except Exception:
+                # a tile that can't be displayed mustn't stay cached, the engine reports it as failed
+                self.image_cache.discard(job.key)
+                raise
+
+        if slot is not None:
+            self.tile_results.put(TileResult(FETCHED, generation, slot, job, tile, image, settings))
+
+    def store_tile(self, job, tile):
+        """
+        Puts a fetched tile into the cache (its key doesn't depend on the view, so it's kept whatever the view is now)
+        """
+        if not job.key in self.image_cache:
+            self.image_cache[job.key] = tile
+
+    def current_centre(self):
+        """
+        Gets the RA and DEC in the middle of the view
+        """
+        return view_centre(self.base_ra, self.base_de, self.shiftx, self.shifty, self.magnification)
+
+    def start_checking(self):
+        """
+        Starts checking for tile results, if that isn't already happening (only one check loop at a time)
+        """
+        if not self.checking_tiles:
+            self.checking_tiles = True
+            CONTROLLER.after(self.CHECK_FREQUENCY, self.check_tiles)
 
+    def check_tiles(self):
+        """
+        Shows each tile fetched or resized for the current generation as soon as it arrives
+        (the middle one is fetched first), finishing the batch once none are being fetched.
+        Everything arrives ready to display, so this only ever puts images on labels
+        """
+        while True:
             try:
-                if not (shiftx, shifty) in self.image_cache:
-                    self.image_cache[(shiftx, shifty)] = image
-            except UnboundLocalError:
-                self.display_error("Whoah man! Easy on the movement! In all seriousness, spamming makes it break, but this can be fixed by just moving again (this time slowly!). " +
-                                   "If you really need to scratch that spamming itch, load the images into the cache (by moving around) and then you can spam to your heart's content " +
-                                   "within the images that you just loaded!", "Spamming is bad")
+                result = self.tile_results.get(block=False)
+            except queue.Empty:
+                break
+
+            # results for a view that has been moved away from never reach the screen
+            if result.generation != self.batch_generation:
+                continue
+
+            self.show_result(result)
+
+        if not self.batch_pending and not self.batch_finished:
+            self.batch_finished = True
+
+            if not self.batch_failed:
+                if self.batch_mode is not None:
+                    self.fetch_engine.mode_selector.record(self.batch_mode, time.time() - self.batch_start)
+
+                self.batch_done(False)
+
+        if self.batch_pending or self.render_pending:
+            CONTROLLER.after(self.CHECK_FREQUENCY, self.check_tiles)
+        else:
+            self.checking_tiles = False
+
+    def show_result(self, result):
+        """
+        Shows a TileResult for the current view
+        """
+        slot = result.slot
+
+        if result.kind == STAND_IN:
+            # only until the real tile arrives
+            if slot in self.batch_pending and result.settings == self.enhancement:
+                self.show_on_label(slot, result.image)
+            return
+
+        if result.kind == RENDERED:
+            # a resize that has been superseded (by new settings) is left for the one that superseded it
+            if self.render_pending.get(slot) != (result.job.key, result.settings):
                 return
-            
-            if not all_cached:
-                self.image_label_list[index].grid_remove()
-            
-            image = image.resize(self.IMAGE_RESOLUTION, ANTIALIAS)
 
-            tk_image = ImageTk.PhotoImage(image)
+            del self.render_pending[slot]
 
-            self.image_label_list[index].configure(image=tk_image)
-            self.image_label_list[index].image = tk_image
+            if result.image is None:
+                self.tile_failed(slot)
+            else:
+                self.show_on_label(slot, result.image, result.job.key, result.settings)
+            return
 
-            self.image_label_list[index].grid()
-    
-    def generate_batch_images(self, shiftx, shifty, new_base_ra=None, new_base_de=None, new_base_magnification=None, overwrite_cache=False):
+        self.batch_pending.discard(slot)
+
+        if result.tile is None:
+            self.tile_failed(slot)
+            return
+
+        self.batch_images[slot] = (result.tile, result.job)
+
+        if result.settings == self.enhancement:
+            self.show_on_label(slot, result.image, result.job.key, result.settings)
+        else:
+            self.show_tile(slot)
+
+    def tile_failed(self, slot):
+        """
+        Hides the label of a tile that couldn't be got (or shown), telling the user once per view
+        """
+        self.image_label_list[slot].loading_token = None
+        self.image_label_list[slot].grid_remove()
+
+        if not self.batch_failed:
+            self.batch_failed = True
+            self.display_error("The images could not be downloaded, please check the connection and try moving again", "Download failed")
+
+    def generate_batch_images(self, shiftx, shifty, new_base_ra=None, new_base_de=None, new_base_magnification=None):
         """
-        Generates all 9 images, either by getting them from the cache or from the interwebz
+        Generates all 9 images, either by getting them from the cache or from the interwebz.
+        The tiles are cached by where they are in the sky, so nothing is thrown away when going to a new place
         """
         print("SHIFTX: " + str(shiftx) + " SHIFTY: " + str(shifty))
-        if overwrite_cache:
-            self.image_cache = {}
 
-        if new_base_ra is not None:
-            self.base_ra = new_base_ra
+        self.prefetcher.record_move(shiftx, shifty)
 
-        if new_base_de is not None:
-            self.base_de = new_base_de
-        
-        if new_base_de is not None or new_base_ra is not None:
-            self.shiftx = 0
-            self.shifty = 0
-        
         if new_base_magnification is not None:
+            # zoom around the middle of the view
+            centre_ra, centre_de = self.current_centre()
             self.magnification = new_base_magnification
+            self.base_ra, self.base_de, self.shiftx, self.shifty = snap_view(centre_ra, centre_de, self.magnification)
 
-        # shift for the middle square
-        self.shiftx += shiftx
-        self.shifty += shifty
-        
-        image_processes = []
-        cached = 0
+        if new_base_de is not None or new_base_ra is not None:
+            centre_ra, centre_de = self.current_centre()
+            new_base_ra = centre_ra if new_base_ra is None else new_base_ra
+            new_base_de = centre_de if new_base_de is None else new_base_de
+
+            self.base_ra, self.base_de, self.shiftx, self.shifty = snap_view(new_base_ra, new_base_de, self.magnification)
+
+        # shift for the middle square (onto another anchor if it's moved into that anchor's cell)
+        self.base_ra, self.base_de, self.shiftx, self.shifty = pan_view(self.base_ra, self.base_de, self.shiftx, self.shifty,
+                                                                        shiftx, shifty, self.magnification)
+
+        self.pyramid.record_view(self.base_ra, self.base_de, self.magnification)
+
+        # the view and the tiles the next move would show (the ones prefetched) stay decoded in memory
+        view = (self.base_ra, self.base_de, self.shiftx, self.shifty, self.magnification)
+        self.image_cache.keep_hot([job.key for job in view_jobs(*view)] + [job.key for _, job in ring_jobs(*view)])
+
+        # anything still being fetched for the last view is superseded
+        self.batch_generation = self.fetch_engine.new_generation()
+        self.batch_images = [None] * 9
+        self.batch_failed = False
+        self.batch_mode = None
+        self.batch_start = time.time()
+        self.render_pending = {}
+
+        missing = []
         
         for index, (aug_shiftx, aug_shifty) in enumerate(self.IMAGE_PIXEL_OFFSETS):
             real_shiftx = self.shiftx + aug_shiftx
             real_shifty = self.shifty + aug_shifty
 
-            if (real_shiftx, real_shifty) in self.image_cache:
+            job = TileJob(self.base_ra, self.base_de, real_shiftx, real_shifty, self.magnification)
+
+            # got in one go, as the fetch and render threads can evict it at any time
+            tile = self.image_cache.get(job.key)
+
+            if tile is not None:
                 print("Cached!")
-                cached += 1
-                safe_put(self.image_queue_list[index], (self.image_cache[(real_shiftx, real_shifty)], real_shiftx, real_shifty))
+                self.batch_images[index] = (tile, job)
                 continue
 
-            image_process = threading.Thread(None, lambda real_shiftx=real_shiftx,real_shifty=real_shifty,index=index: safe_put(self.image_queue_list[index],
-                                                                                                                                (get_sky_picture(self.base_ra, self.base_de, real_shiftx, real_shifty, self.magnification),
-                                                                                                                                 real_shiftx, real_shifty)))
-            image_process.setDaemon(True)
-            image_process.start()
+            missing.append((index, job))
 
-            image_processes.append(image_process)
+        self.batch_pending = set(index for index, _ in missing)
+        self.batch_finished = not self.batch_pending
 
-        if not cached == 9:
-            for label in self.image_label_list:
-                label.grid_remove()
-        
-            self.load_label.grid(row=2, column=2)
-            CONTROLLER.after(self.LOADING_GIF_FREQUENCY, lambda: self.update_loading_gif(1, self.load_label, time.time()))
+        # a whole new view can come as one mosaic, if that's been faster on this link
+        if len(missing) == 9 and not any(is_sky_picture_on_disk(*job) for _, job in missing):
+            self.batch_mode = self.fetch_engine.mode_selector.choose()
+
+        if self.batch_mode == MOSAIC:
+            self.fetch_engine.submit(MosaicJob(self.base_ra, self.base_de, self.shiftx, self.shifty, self.magnification),
+                                     CENTRE_PRIORITY, 4)
+        else:
+            for index, job in missing:
+                priority = CENTRE_PRIORITY if self.IMAGE_PIXEL_OFFSETS[index] == (0, 0) else VISIBLE_PRIORITY
+
+                self.fetch_engine.submit(job, priority, index)
+
+        if not self.batch_pending:
+            self.shift_tiles()
+            self.batch_done(True)
+            return
+
+        self.shift_tiles()
+
+        # cached tiles go up straight away, and only the pending ones get a loading gif
+        for index in range(9):
+            if self.batch_images[index] is not None:
+                self.show_tile(index)
+            else:
+                self.show_loading(index)
+
+        # after a zoom, tiles cached at the other magnifications stand in (once made on a render thread)
+        # until the real ones arrive
+        if new_base_magnification is not None:
+            for index, job in missing:
+                self.render_executor.submit(self.render_stand_in, self.batch_generation, index, job, self.enhancement)
+
+        self.start_checking()
+
+    def batch_done(self, all_cached):
+        """
+        Makes sure all the images are displayed once they're all there, then prefetches the tiles around them
+        """
+        self.display_image(all_cached)
+
+        self.prefetcher.prefetch(self.base_ra, self.base_de, self.shiftx, self.shifty, self.magnification, skip=self.image_cache)
 
-        CONTROLLER.after(self.CHECK_FREQUENCY,
-                         lambda: self.check_thread(image_processes,
-                                                   lambda cached=cached: self.display_image(cached == 9),
-                                                   True))
-    
     def wifi_button_func(self):
         """
         Unbinds all arrow keys and shows the wifi screen
@@ -521,34 +974,35 @@ class AstroScreen(Page):
             GPIO.add_event_detect(18, GPIO.FALLING, callback=lambda e: self.generate_batch_images(256, 0), bouncetime=1250)
             GPIO.add_event_detect(27, GPIO.FALLING, callback=lambda e: self.generate_batch_images(0, 256), bouncetime=1250)
 
+    def planet_coords(self):
+        """
+        Gets the latest planet coordinates (without waiting, and empty until the first have been worked out)
+        """
+        snapshot = PLANET_SNAPSHOTS.latest()
+
+        if snapshot is None:
+            return []
+
+        return snapshot.coords
+
     def show_planet(self, index):
         """
         Shows the location where a planet is at the specified time
         """
         try:
-            self.all_coords = PLANET_COORDINATES.get(block=False)
-        except queue.Empty:
-            pass
-        
-        try:
-            planet_ra, planet_de = self.all_coords[index]
+            planet_ra, planet_de = self.planet_coords()[index]
         except IndexError:
             self.display_error("The planet data has not been generated yet, please wait for the prompt then try again", "Data not available")
             return
 
-        self.generate_batch_images(0, 0, planet_ra, planet_de, overwrite_cache=True)
+        self.generate_batch_images(0, 0, planet_ra, planet_de)
     
     def show_planet_info(self, index):
         """
         Shows the planet info for the planet at the specified time
         """
         try:
-            self.all_coords = PLANET_COORDINATES.get(block=False)
-        except queue.Empty:
-            pass
-        
-        try:
-            planet_ra, planet_de = self.all_coords[index]
+            planet_ra, planet_de = self.planet_coords()[index]
         except IndexError:
             self.display_error("The planet data has not been generated yet, please wait for the prompt then try again", "Data not available")
             return
@@ -590,7 +1044,7 @@ Within {} (Constellation)
             self.display_error("This object \"{}\" is not recognised, please choose another object\nNote: Solar system objects must be selected from their menu".format(obj), "Object not recognised")
             return
 
-        self.generate_batch_images(0, 0, righta, dec, overwrite_cache=True)
+        self.generate_batch_images(0, 0, righta, dec)
     
     def show_object_info(self):
         """
@@ -641,14 +1095,11 @@ Within {} (Constellation)
         impeders = []
         warnings = []
 
+        all_coords = self.planet_coords()
+
         try:
-            self.all_coords = PLANET_COORDINATES.get(block=False)
-        except queue.Empty:
-            pass
-        
-        try:
-            moon_ra, moon_dec = self.all_coords[8]
-            sun_ra, sun_dec = self.all_coords[9]
+            moon_ra, moon_dec = all_coords[8]
+            sun_ra, sun_dec = all_coords[9]
 
             moon_az, moon_alt = get_coordinates_from_observer(moon_ra, moon_dec, location, obstime)
             sun_alt = get_coordinates_from_observer(sun_ra, sun_dec, location, obstime)[1]
@@ -717,11 +1168,13 @@ Within {} (Constellation)
             return
 
         self.location = location
+        self.update_planets()
+
         self.display_info("Location successfully changed to \"{}\"".format(location), "Location change successful")
 
-    def update_time(self, obstime):
+    def update_time(self, obstime, manual=True):
         """
-        Updates the time at which you view the stars
+        Updates the time at which you view the stars (manual=False to follow the current time again)
         """
         try:
             Time(obstime)
@@ -730,7 +1183,8 @@ Within {} (Constellation)
             return
         
         self.time = obstime
-        self.time_manual = True
+        self.time_manual = manual
+        self.update_planets()
 
         self.display_info("Time successfully changed to \"{}\"".format(obstime), "Time change successful")
     
@@ -746,47 +1200,140 @@ Within {} (Constellation)
 
         full_path = self.latest_file_loc + fil_name + ".png"
 
-        full_im = Image.new('RGB', (768, 768))
-
-        for shiftx, shifty in self.IMAGE_PIXEL_OFFSETS:
-            true_shiftx = shiftx + self.shiftx
-            true_shifty = shifty + self.shifty
-
-            positional_shiftx = abs(shiftx - 256)
-            positional_shifty = abs(shifty - 256)
-
-            full_im.paste(self.image_cache[(true_shiftx, true_shifty)], (positional_shiftx, positional_shifty))
-        
-        full_im.save(full_path)
+        self.export_mosaic(full_path, 3, 3)
     
     def save_as_image(self):
         """
         Saves the current image, having been provided with a path
         """
+        fil = self.ask_save_path()
+
+        if fil == '':
+            return
+
+        self.export_mosaic(fil, 3, 3)
+
+    def save_large_image(self):
+        """
+        Saves a mosaic of any number of tiles around the middle of the view, having been provided with its size and a path
+        """
+        columns = simpledialog.askinteger("Mosaic size", "How many tiles across should the mosaic be? (The view is 3 across)",
+                                          minvalue=1, maxvalue=self.MAX_EXPORT_TILES, parent=self)
+        if columns is None:
+            return
+
+        rows = simpledialog.askinteger("Mosaic size", "How many tiles down should the mosaic be? (The view is 3 down)",
+                                       minvalue=1, maxvalue=self.MAX_EXPORT_TILES, parent=self)
+        if rows is None:
+            return
+
+        fil = self.ask_save_path()
+
+        if fil == '':
+            return
+
+        # only PNGs are written a row at a time, anything else this big could run out of memory
+        if columns * rows > MAX_UNSTREAMED_TILES and not is_streamed(fil):
+            fil = os.path.splitext(fil)[0] + '.png'
+            self.display_info("Mosaics of more than {} tiles can only be saved as PNGs, so it will be saved as \"{}\""
+                              .format(MAX_UNSTREAMED_TILES, os.path.basename(fil)), "Saving as PNG")
+
+        self.export_mosaic(fil, columns, rows)
+
+    def ask_save_path(self):
+        """
+        Asks where to save a picture (remembering the folder for "Save"), giving '' if cancelled
+        """
         fil = filedialog.asksaveasfilename(defaultextension='.png', filetypes=[("PNG", ".png"), ("JPEG", ".jpeg"),
                                                                            ("JPEG", ".jpg"), ("GIF", ".gif"),
                                                                            ("BMP", ".bmp")],
                                        initialdir=SAVE_INITIAL_DIR, initialfile=time.strftime("%Y-%m-%d %Hh %Mm %Ss"), parent=self, title="Save Image")
         
         if fil == '':
-            return
+            return ''
 
         self.latest_file_loc = '/'.join(fil.split('/')[:-1]) + '/'
 
         print(self.latest_file_loc)
 
-        full_im = Image.new('RGB', (768, 768))
+        return fil
 
-        for shiftx, shifty in self.IMAGE_PIXEL_OFFSETS:
-            true_shiftx = shiftx + self.shiftx
-            true_shifty = shifty + self.shifty
+    def open_tile_pack(self):
+        """
+        Reads the tiles from a pack made with "get_picture.py pack", optionally never using the network at all
+        """
+        fil = filedialog.askopenfilename(filetypes=[("Tile pack", ".pack"), ("All files", "*")], parent=self, title="Open tile pack")
 
-            positional_shiftx = abs(shiftx - 256)
-            positional_shifty = abs(shifty - 256)
+        if fil == '' or fil == ():
+            return
 
-            full_im.paste(self.image_cache[(true_shiftx, true_shifty)], (positional_shiftx, positional_shifty))
-        
-        full_im.save(fil)
+        pack_only = messagebox.askyesno("Tile pack", "Only use the tiles in the pack (never use the network)?", parent=self)
+
+        try:
+            tile_pack = use_tile_pack(fil, pack_only)
+        except (OSError, ValueError) as error:
+            self.display_error("The tile pack could not be opened ({})".format(error), "Invalid tile pack")
+            return
+
+        self.display_info("{} tiles will be read from the pack".format(len(tile_pack)), "Tile pack opened")
+
+        # tiles that failed before may be in the pack
+        self.generate_batch_images(0, 0)
+
+    def close_tile_pack(self):
+        """
+        Goes back to downloading the tiles
+        """
+        stop_using_tile_pack()
+
+        self.generate_batch_images(0, 0)
+
+    def export_mosaic(self, path, columns, rows):
+        """
+        Saves a mosaic of columns x rows tiles around the middle of the view in the background,
+        fetching any tiles that aren't cached and showing its progress
+        """
+        if self.export is not None:
+            self.display_warning("A picture is already being saved, please wait for it to finish or cancel it", "Already saving")
+            return
+
+        self.export = MosaicExport(self.base_ra, self.base_de, self.shiftx, self.shifty, self.magnification,
+                                   columns, rows, path, memory_cache=self.image_cache)
+        self.export.start()
+
+        self.export_window = tk.Toplevel(self, background='black')
+        self.export_window.title("Saving")
+        self.export_window.protocol("WM_DELETE_WINDOW", self.export.cancel)
+
+        self.export_window.label = tk.Label(self.export_window, font=("Helvetica", self.MENU_FONT_SIZE), bg='black', fg='white')
+        self.export_window.label.grid(row=0, column=0, padx=16, pady=16)
+
+        cancel_button = tk.Button(self.export_window, text="Cancel", command=self.export.cancel, font=("Helvetica", self.MENU_FONT_SIZE),
+                                  fg='red', activeforeground='red', bg='black', activebackground='#262626')
+        cancel_button.grid(row=1, column=0, pady=16)
+
+        self.check_export()
+
+    def check_export(self):
+        """
+        Shows the progress of the mosaic being saved, until it's done
+        """
+        export = self.export
+
+        if not export.finished:
+            self.export_window.label.configure(text="Saved {} of {} tiles ({}%)".format(export.tiles_done, export.total_tiles,
+                                                                                        int(export.progress * 100)))
+            CONTROLLER.after(self.CHECK_FREQUENCY, self.check_export)
+            return
+
+        self.export_window.destroy()
+        self.export_window = None
+        self.export = None
+
+        if export.error is not None:
+            self.display_error(export.error, "Save failed")
+        elif not export.cancelled and export.total_tiles > 9:
+            self.display_info("The mosaic has been saved to \"{}\"".format(export.path), "Mosaic saved")
 
     def render(self, referral=False):
         """
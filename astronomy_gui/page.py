@@ -22,6 +22,12 @@ class Page(tk.Frame):
     # size of the menu fonts
     MENU_FONT_SIZE = 20
 
+    # (gif path, subsample) -> frames of the loading gif, decoded once and shared by every page
+    loading_gif_frames = {}
+
+    # number of gif frames decoded from disk (for monitoring)
+    loading_frames_decoded = 0
+
     def __init__(self, parent):
         """
         Sets up a generic page, but is always overridden
@@ -40,26 +46,53 @@ class Page(tk.Frame):
         '''
         pass
     
-    def update_loading_gif(self, index, label, start_time):
+    def update_loading_gif(self, index, label, start_time, token=None, subsample=1):
         '''
-        Update gif things
+        Update gif things, stopping once the label's loading_token is no longer token (if one is given),
+        and shrinking the gif by subsample
         '''
         
         if not label.winfo_ismapped() and time.time() - start_time > self.LOADING_GIF_KILL:
             return
 
-        try:
-            loading_image = tk.PhotoImage(file=self.loading_gif_path,
-                                          format="gif -index {}".format(index))
-        except tk.TclError:
-            loading_image = tk.PhotoImage(file=self.loading_gif_path, format="gif -index 0")
-            index = 0
+        if token is not None and getattr(label, 'loading_token', None) != token:
+            return
+
+        frames = self.get_loading_frames(subsample)
+
+        index %= len(frames)
+        loading_image = frames[index]
 
         label.configure(image=loading_image)
         label.image = loading_image
 
-        CONTROLLER.after(self.LOADING_GIF_FREQUENCY, lambda: self.update_loading_gif(index+1, label, start_time))
+        CONTROLLER.after(self.LOADING_GIF_FREQUENCY, lambda: self.update_loading_gif(index+1, label, start_time, token, subsample))
     
+    def get_loading_frames(self, subsample=1):
+        '''
+        Gets every frame of the loading gif (shrunk by subsample), only reading them from disk the first time
+        '''
+        key = (self.loading_gif_path, subsample)
+
+        if key not in Page.loading_gif_frames:
+            frames = []
+
+            while True:
+                try:
+                    frame = tk.PhotoImage(file=self.loading_gif_path, format="gif -index {}".format(len(frames)))
+                except tk.TclError:
+                    break
+
+                if subsample > 1:
+                    frame = frame.subsample(subsample)
+
+                frames.append(frame)
+
+            Page.loading_frames_decoded += len(frames)
+            Page.loading_gif_frames[key] = frames
+
+        return Page.loading_gif_frames[key]
+
     def check_thread(self, thread, callback, many=False):
         """
         Checks if a thread is finished, and if so, calls a callback
@@ -0,0 +1,73 @@
+'''Enhancement of the tiles for display: contrast stretch, gamma and a red night vision mode'''
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from sky_tile import image_to_pixels, pixels_to_image
+
+# Weights (out of 256) of the red, green and blue channels in the brightness of a pixel
+LUMINANCE_WEIGHTS = np.array([77, 150, 29], np.uint16)
+
+class EnhanceSettings(namedtuple('EnhanceSettings', ['black_point', 'white_point', 'gamma', 'night_vision'])):
+    """
+    How the tiles are enhanced: levels at or below black_point go black and at or above white_point go white,
+    with gamma (above 1 brightens the faint stuff) applied to what's in between.
+    Night vision shows everything in red only, to keep dark adapted eyes dark adapted
+    """
+    __slots__ = ()
+
+    def __new__(cls, black_point=0, white_point=255, gamma=1.0, night_vision=False):
+        return super().__new__(cls, black_point, white_point, gamma, night_vision)
+
+    @property
+    def changes_anything(self):
+        """
+        Whether enhancing with these settings changes a tile at all
+        """
+        return self != NO_ENHANCEMENT
+
+# Settings that leave the tiles as they are
+NO_ENHANCEMENT = EnhanceSettings()
+
+@lru_cache(maxsize=16)
+def lookup_table(settings):
+    """
+    Gets the 256 output levels for each input level with some settings (only worked out once per settings)
+    """
+    levels = np.arange(256, dtype=np.float32)
+
+    stretched = np.clip((levels - settings.black_point) / max(1, settings.white_point - settings.black_point), 0, 1)
+
+    return np.round(255 * stretched ** (1 / settings.gamma)).astype(np.uint8)
+
+def enhance_pixels(pixels, settings):
+    """
+    Enhances an array of pixels (greyscale, or RGB with any extra channels dropped), giving a new array
+    """
+    if not settings.changes_anything:
+        return pixels
+
+    table = lookup_table(settings)
+
+    if not settings.night_vision:
+        return table[pixels]
+
+    if pixels.ndim == 3:
+        brightness = (pixels[:, :, :3] @ LUMINANCE_WEIGHTS) >> 8
+    else:
+        brightness = pixels
+
+    night_pixels = np.zeros(brightness.shape + (3,), np.uint8)
+    night_pixels[:, :, 0] = table[brightness]
+
+    return night_pixels
+
+def enhance_image(image, settings):
+    """
+    Enhances an image (like enhance_pixels), giving a new image
+    """
+    if not settings.changes_anything:
+        return image
+
+    return pixels_to_image(enhance_pixels(image_to_pixels(image), settings))
@@ -0,0 +1,227 @@
+'''One long-lived thread keeping the planet positions up to date, each body at its own pace'''
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from planets import MAPPING_DICT, PLANET_SNAPSHOTS, get_interpolated_planet_coords
+
+# Seconds between updates of each body while following the current time
+# (the Moon moves about half an arcsecond a second, the outer planets hardly move in a night)
+REFRESH_SECONDS = OrderedDict([
+    ['Mercury', 60],
+    ['Venus', 60],
+    ['Mars', 120],
+    ['Jupiter', 300],
+    ['Saturn', 600],
+    ['Uranus', 1800],
+    ['Neptune', 1800],
+    ['Pluto', 3600],
+    ['Moon', 10],
+    ['Sun', 30]
+])
+
+# Bodies due within this many seconds of each other are updated together
+COALESCE_SECONDS = 1
+
+# Seconds before trying again after an update failed
+RETRY_SECONDS = 30
+
+class EphemerisScheduler:
+    """
+    Updates the planet positions for a screen's time and location on one background thread.
+    Each update is published as a snapshot in PLANET_SNAPSHOTS.
+    While following the current time each body is updated as often as it moves enough to matter;
+    with a fixed time nothing changes, so nothing is updated until the time or location does.
+    replan() (or a change of time or location being noticed) updates every body straight away
+    """
+    def __init__(self, screen, refresh_seconds=REFRESH_SECONDS):
+        """
+        Sets up the scheduler for a screen (start() starts it)
+        """
+        self.screen = screen
+        self.refresh_seconds = [refresh_seconds[name] for name in MAPPING_DICT]
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._replan = True
+        self._coords = None
+        self._body_times = [None] * len(MAPPING_DICT)
+        # time.time() each body is next due (None if it never is until a replan)
+        self._next_due = [0] * len(MAPPING_DICT)
+        self._planned_for = None
+
+        self.updates = 0
+        self.failures = 0
+        self.last_update = None
+        self.last_duration = None
+        self.error = None
+
+    @property
+    def running(self):
+        """
+        Whether the scheduler thread is running
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the scheduler thread (does nothing if it's already running)
+        """
+        with self._lock:
+            if self.running:
+                return
+
+            self._stopping.clear()
+            self._replan = True
+
+            self._thread = threading.Thread(None, self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self, wait=False):
+        """
+        Stops the scheduler thread once it has finished any update it's doing
+        """
+        self._stopping.set()
+        self._wake.set()
+
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def replan(self):
+        """
+        Updates every body straight away, for a new time or location
+        """
+        with self._lock:
+            self._replan = True
+
+        self._wake.set()
+
+    def status(self):
+        """
+        Gets what the scheduler is doing, as a dictionary (for monitoring)
+        """
+        now = time.time()
+
+        with self._lock:
+            next_due = OrderedDict((name, None if due is None else max(0, due - now))
+                                   for name, due in zip(MAPPING_DICT, self._next_due))
+
+            return {
+                'running': self.running,
+                'planned_for': self._planned_for,
+                'updates': self.updates,
+                'failures': self.failures,
+                'last_update': self.last_update,
+                'last_duration': self.last_duration,
+                'error': self.error,
+                'next_due': next_due
+            }
+
+    def _settings(self):
+        """
+        Gets the screen's time and location, with the time only mattering if it's fixed
+        """
+        if self.screen.time_manual:
+            return self.screen.location, self.screen.time
+
+        return self.screen.location, None
+
+    def _wait_time(self):
+        """
+        Gets the seconds until the next body is due (None if none ever are)
+        """
+        with self._lock:
+            if self._replan:
+                return 0
+
+            due_times = [due for due in self._next_due if due is not None]
+
+        if not due_times:
+            return None
+
+        return max(0, min(due_times) - time.time())
+
+    def _run(self):
+        """
+        Updates whichever bodies are due, then sleeps until the next are (runs on the scheduler thread)
+        """
+        while not self._stopping.is_set():
+            self._wake.wait(self._wait_time())
+            self._wake.clear()
+
+            if self._stopping.is_set():
+                break
+
+            settings = self._settings()
+
+            with self._lock:
+                replan = self._replan or self._coords is None or settings != self._planned_for
+                self._replan = False
+
+                now = time.time()
+                due = [index for index, next_due in enumerate(self._next_due)
+                       if replan or (next_due is not None and next_due <= now + COALESCE_SECONDS)]
+
+            if due:
+                self._update(settings, due)
+
+    def _update(self, settings, due):
+        """
+        Updates the positions of some bodies (only interpolating those) and publishes them with the rest
+        """
+        location, obstime = settings
+        start_time = time.time()
+
+        manual = obstime is not None
+        if not manual:
+            obstime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time))
+
+        # every body is needed if there's nothing to keep the others from
+        with self._lock:
+            if self._coords is None:
+                due = list(range(len(MAPPING_DICT)))
+
+        try:
+            new_coords = get_interpolated_planet_coords(obstime, location, True, due)
+        except Exception as error:
+            print("Planet update failed, trying again in {}s: {}".format(RETRY_SECONDS, error))
+
+            with self._lock:
+                self.error = str(error)
+                self.failures += 1
+                self._next_due = [start_time + RETRY_SECONDS] * len(MAPPING_DICT)
+                self._replan = False
+                self._coords = None
+
+            return
+
+        with self._lock:
+            if self._coords is None or len(due) == len(MAPPING_DICT):
+                coords = np.empty((len(MAPPING_DICT), 2))
+            else:
+                coords = self._coords.copy()
+
+            coords[due] = new_coords
+
+            for index in due:
+                self._body_times[index] = obstime
+                # a fixed time never needs updating again
+                self._next_due[index] = None if manual else start_time + self.refresh_seconds[index]
+
+            self._coords = coords
+            self._planned_for = settings
+
+            self.updates += 1
+            self.last_update = time.time()
+            self.last_duration = self.last_update - start_time
+            self.error = None
+
+            body_times = list(self._body_times)
+
+        PLANET_SNAPSHOTS.publish(coords, location, obstime, body_times, manual)
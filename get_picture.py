@@ -1,10 +1,56 @@
+import argparse
+import math
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 
 import requests
 from PIL import Image
 
+import planets
 import tools
+from image_workers import IMAGE_WORKERS
+from single_flight import SingleFlight
+from sky_grid import MIN_COS_DEC, TILE_PIXELS, VIEW_OFFSETS, snap_views_near, tile_angle
+from sky_tile import SkyTile, image_to_pixels
+from tile_cache import DISK_TILE_CACHE, tile_cache_key
+from tile_client import TILE_CLIENT, TileFetchError
+from tile_pack import TilePack, TilePackWriter
+
+# Downloads (and decodes) of the same cutout that overlap share one fetch
+DATA_FLIGHTS = SingleFlight()
+PICTURE_FLIGHTS = SingleFlight()
+
+# Number of tiles downloaded at once when building a pack
+PACK_WORKERS = 8
+
+# The tile pack being read from (None if there isn't one), and whether tiles not in it are left alone rather than downloaded
+TILE_PACK = None
+PACK_ONLY = False
+
+def use_tile_pack(path, pack_only=True):
+    """
+    Reads tiles from a pack file from now on, and if pack_only never goes to the network for the ones not in it.
+    Returns the TilePack
+    """
+    global TILE_PACK, PACK_ONLY
+
+    TILE_PACK = TilePack(path)
+    PACK_ONLY = pack_only
+
+    return TILE_PACK
+
+def stop_using_tile_pack():
+    """
+    Goes back to getting tiles from the disk cache and the network only
+    """
+    global TILE_PACK, PACK_ONLY
+
+    # not closed, as a fetch thread may still be reading from it
+    TILE_PACK = None
+    PACK_ONLY = False
 
 def old_get_sky_picture(param_dict={}, ra=None, de=None):
     """
@@ -30,13 +76,13 @@ def old_get_sky_picture(param_dict={}, ra=None, de=None):
     #image.save('noot.png')
 
 
-def get_sky_picture(base_ra, base_de, shiftx=0, shifty=0, magnification_level=0):
+def _imgcut_params(base_ra, base_de, shiftx, shifty, magnification_level, tiles=1):
     """
-    Gets the picture of a specific part of the sky, by giving RA and DEC and a magnification
+    Gets the imgcut parameters of a square of tiles x tiles tiles centred on a shift
     """
     param_dict = {'survey':'DSS2'}
 
-    param_dict['angle'] = 1.25 * (0.75**magnification_level)
+    param_dict['angle'] = tile_angle(magnification_level) * tiles
 
     param_dict['ra'] = base_ra
     param_dict['de'] = base_de
@@ -44,19 +90,293 @@ def get_sky_picture(base_ra, base_de, shiftx=0, shifty=0, magnification_level=0)
     param_dict['x_shift'] = shiftx
     param_dict['y_shift'] = shifty
 
-    while True:
-        try:
-            http_response = requests.get('http://server{}.wikisky.org/imgcut'.format(random.randint(1, 9)),
-                                         params=param_dict, timeout=0.5)
-            break
-        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout):
-            continue
+    if tiles != 1:
+        param_dict['w'] = param_dict['h'] = TILE_PIXELS * tiles
 
-    image = Image.open(BytesIO(http_response.content))
+    return param_dict
+
+def _params_cache_key(param_dict):
+    """
+    Gets the disk cache key of some imgcut parameters
+    """
+    return tile_cache_key(param_dict['survey'], param_dict['ra'], param_dict['de'], param_dict['x_shift'],
+                          param_dict['y_shift'], param_dict['angle'], param_dict.get('w', TILE_PIXELS))
 
-    print("Pic got")
+def _get_tile_data(param_dict, use_cache=True):
+    """
+    Gets the raw data of a cutout from the disk cache, or from the interwebz (caching it).
+    Threads asking for the same cutout at the same time all get the result of one fetch
+    """
+    cache_key = _params_cache_key(param_dict)
 
-    return image
+    return DATA_FLIGHTS.do((cache_key, use_cache), lambda: _fetch_tile_data(cache_key, param_dict, use_cache))
+
+def _check_tile_data(data, source):
+    """
+    Checks (from its header) that some raw data is an image, as mirrors sometimes send back
+    error pages as if they were tiles. Raises TileFetchError if it isn't
+    """
+    try:
+        Image.open(BytesIO(data))
+    except (OSError, SyntaxError, ValueError) as error:
+        raise TileFetchError(0, 0, "{} gave something that isn't an image ({})".format(source, error))
+
+def _fetch_tile_data(cache_key, param_dict, use_cache):
+    """
+    Gets the raw data of a cutout, without coalescing
+    """
+    tile_pack = TILE_PACK
+
+    if use_cache and tile_pack is not None:
+        tile_data = tile_pack.get(cache_key)
+
+        if tile_data is not None:
+            print("Pic got (tile pack)")
+            return tile_data
+
+        if PACK_ONLY:
+            raise TileFetchError(0, 0, "not in the tile pack {}".format(tile_pack.path))
+
+    if use_cache:
+        tile_data = DISK_TILE_CACHE.get(cache_key)
+
+        if tile_data is not None:
+            try:
+                _check_tile_data(tile_data, "The disk cache")
+                print("Pic got (disk cache)")
+                return tile_data
+            except TileFetchError as error:
+                # cached before tiles were checked, it's downloaded again
+                print(error)
+                DISK_TILE_CACHE.discard(cache_key)
+
+    # raises TileFetchError if every attempt fails
+    fetch_result = TILE_CLIENT.fetch(param_dict)
+
+    # only images are ever cached
+    _check_tile_data(fetch_result.content, fetch_result.mirror)
+
+    DISK_TILE_CACHE.put(cache_key, fetch_result.content)
+
+    print("Pic got from {} ({} attempts{}, {}s)".format(fetch_result.mirror, fetch_result.attempts,
+                                                        ", hedged" if fetch_result.hedged else "",
+                                                        round(fetch_result.elapsed, 2)))
+
+    return fetch_result.content
+
+def is_sky_picture_on_disk(base_ra, base_de, shiftx=0, shifty=0, magnification_level=0):
+    """
+    Checks (without waiting) if a picture is in the disk cache (or the tile pack)
+    """
+    cache_key = _params_cache_key(_imgcut_params(base_ra, base_de, shiftx, shifty, magnification_level))
+    tile_pack = TILE_PACK
+
+    return cache_key in DISK_TILE_CACHE or (tile_pack is not None and cache_key in tile_pack)
+
+def get_sky_tile(base_ra, base_de, shiftx=0, shifty=0, magnification_level=0, use_cache=True):
+    """
+    Gets the picture of a specific part of the sky as an undecoded SkyTile
+    """
+    param_dict = _imgcut_params(base_ra, base_de, shiftx, shifty, magnification_level)
+
+    return SkyTile(_get_tile_data(param_dict, use_cache))
+
+def get_sky_picture(base_ra, base_de, shiftx=0, shifty=0, magnification_level=0, use_cache=True):
+    """
+    Gets the picture of a specific part of the sky, by giving RA and DEC and a magnification.
+    Threads asking for the same picture at the same time share one decoded image (so shouldn't change it)
+    """
+    param_dict = _imgcut_params(base_ra, base_de, shiftx, shifty, magnification_level)
+
+    return PICTURE_FLIGHTS.do((_params_cache_key(param_dict), use_cache),
+                              lambda: _decode_sky_picture(base_ra, base_de, shiftx, shifty, magnification_level, use_cache))
+
+def _decode_sky_picture(base_ra, base_de, shiftx, shifty, magnification_level, use_cache):
+    """
+    Gets and fully decodes a picture, without coalescing
+    """
+    return IMAGE_WORKERS.decode(get_sky_tile(base_ra, base_de, shiftx, shifty, magnification_level, use_cache))
+
+def get_sky_mosaic(base_ra, base_de, shiftx=0, shifty=0, magnification_level=0, use_cache=True):
+    """
+    Gets the whole 3x3 view around a shift with one request, sliced into the 9 tiles
+    (SkyTiles, in the order of VIEW_OFFSETS)
+    """
+    param_dict = _imgcut_params(base_ra, base_de, shiftx, shifty, magnification_level, tiles=3)
+
+    mosaic = Image.open(BytesIO(_get_tile_data(param_dict, use_cache)))
+
+    if mosaic.size != (3 * TILE_PIXELS, 3 * TILE_PIXELS):
+        mosaic = mosaic.resize((3 * TILE_PIXELS, 3 * TILE_PIXELS))
+
+    # decoded into one array, which the tiles are views into
+    pixels = image_to_pixels(mosaic)
+
+    tiles = []
+
+    for offset_x, offset_y in VIEW_OFFSETS:
+        # the same positions the tiles are pasted at when saving
+        left = TILE_PIXELS - offset_x
+        top = TILE_PIXELS - offset_y
+
+        tiles.append(SkyTile(pixels=pixels[top:top + TILE_PIXELS, left:left + TILE_PIXELS]))
+
+    return tiles
+
+def benchmark_fetch_modes(base_ra, base_de, magnification_level=0, rounds=3):
+    """
+    Times getting a 3x3 view as nine requests (in parallel, like the screen does)
+    and as one mosaic request, bypassing the disk cache.
+    Returns the average seconds of each as (nine, mosaic)
+    """
+    nine_times = []
+    mosaic_times = []
+
+    for round_number in range(rounds):
+        # move along each round so the server can't have the cutouts cached either
+        shiftx = round_number * 3 * TILE_PIXELS
+
+        start_time = time.time()
+        threads = [threading.Thread(None, lambda offset=offset: get_sky_picture(base_ra, base_de, shiftx + offset[0], offset[1],
+                                                                                magnification_level, False).load())
+                   for offset in VIEW_OFFSETS]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        nine_times.append(time.time() - start_time)
+
+        start_time = time.time()
+        get_sky_mosaic(base_ra, base_de, shiftx + 9 * TILE_PIXELS * rounds, 0, magnification_level, False)
+        mosaic_times.append(time.time() - start_time)
+
+    return sum(nine_times) / rounds, sum(mosaic_times) / rounds
+
+def region_targets(ra_min, ra_max, de_min, de_max, magnification_level):
+    """
+    Gets RA and DECs about half a tile apart covering a region (RA in hours, wrapping round 24 if ra_min > ra_max)
+    """
+    if ra_max < ra_min:
+        ra_max += 24
+
+    # half a tile apart, so every tile of the grid gets one however the anchor's grid is turned against RA and DEC
+    step = tile_angle(magnification_level) / 2
+
+    targets = []
+
+    de_count = int(math.ceil((de_max - de_min) / step))
+    for de_index in range(de_count + 1):
+        de = min(de_max, de_min + de_index * step)
+
+        ra_step = step / 15 / max(math.cos(math.radians(de)), MIN_COS_DEC)
+        ra_count = int(math.ceil((ra_max - ra_min) / ra_step))
+
+        for ra_index in range(ra_count + 1):
+            targets.append((min(ra_max, ra_min + ra_index * ra_step) % 24, de))
+
+    return targets
+
+def pack_tile_params(targets, magnification_level, radius=1):
+    """
+    Gets the imgcut parameters of every tile the screen needs to look at some RA and DECs:
+    each view it could be in the middle of on the tile grid, with radius tiles all round its middle tile
+    """
+    param_dicts = {}
+
+    for ra, de in targets:
+        # near the edge of an anchor's cell the screen can be on either anchor
+        for anchor_ra, anchor_de, shiftx, shifty in snap_views_near(ra, de, magnification_level):
+            for offset_x in range(-radius, radius + 1):
+                for offset_y in range(-radius, radius + 1):
+                    param_dict = _imgcut_params(anchor_ra, anchor_de, shiftx + offset_x * TILE_PIXELS, shifty + offset_y * TILE_PIXELS,
+                                                magnification_level)
+                    param_dicts[_params_cache_key(param_dict)] = param_dict
+
+    return list(param_dicts.values())
+
+def _get_pack_tile(param_dict):
+    """
+    Gets the raw data of a tile for a pack, from the disk cache if it's there (without filling it up with the pack)
+    """
+    cache_key = _params_cache_key(param_dict)
+
+    tile_data = DISK_TILE_CACHE.get(cache_key)
+
+    if tile_data is None:
+        fetch_result = TILE_CLIENT.fetch(param_dict)
+        tile_data = fetch_result.content
+        source = fetch_result.mirror
+    else:
+        source = "The disk cache"
+
+    _check_tile_data(tile_data, source)
+
+    return cache_key, tile_data
+
+def build_tile_pack(path, param_dicts, workers=PACK_WORKERS):
+    """
+    Downloads tiles into a pack file, skipping the ones already in it (so an interrupted run can just be started again).
+    Returns the number of tiles (added, failed)
+    """
+    writer = TilePackWriter(path)
+
+    to_get = [param_dict for param_dict in param_dicts if not _params_cache_key(param_dict) in writer]
+    print("{} tiles, {} already in the pack".format(len(param_dicts), len(param_dicts) - len(to_get)))
+
+    added = 0
+    failed = 0
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        futures = [executor.submit(_get_pack_tile, param_dict) for param_dict in to_get]
+
+        for future in as_completed(futures):
+            try:
+                cache_key, tile_data = future.result()
+            except TileFetchError as error:
+                print(error)
+                failed += 1
+                continue
+
+            writer.add(cache_key, tile_data)
+            added += 1
+
+            print("{} of {} tiles downloaded".format(added + failed, len(to_get)))
+    finally:
+        # whatever was downloaded is kept and indexed, even if stopped part way
+        executor.shutdown(wait=False)
+        writer.close()
+
+    return added, failed
+
+def pack_command(args):
+    """
+    Builds a tile pack from the command line arguments
+    """
+    targets = [tuple(target) for target in args.target]
+
+    if args.planets:
+        obstime = args.time or time.strftime("%Y-%m-%d %H:%M:%S")
+        targets.extend(tuple(coords) for coords in planets.get_planet_coords(obstime, args.location, True))
+
+    param_dicts = []
+
+    for magnification_level in args.magnifications:
+        level_targets = list(targets)
+
+        if args.region is not None:
+            level_targets.extend(region_targets(*args.region, magnification_level))
+
+        param_dicts.extend(pack_tile_params(level_targets, magnification_level, args.radius))
+
+    if not param_dicts:
+        print("Nothing to pack, give a --region, --target or --planets")
+        return
+
+    added, failed = build_tile_pack(args.output, param_dicts, args.workers)
+
+    print("{} tiles added to {}, {} failed (run again to retry them)".format(added, args.output, failed))
 
 def prompt_sky_picture():
     """
@@ -76,5 +396,38 @@ def prompt_sky_picture():
 
     get_sky_picture(base_ra=righta, base_de=dec)
 
+def main():
+    """
+    Runs the command line tools (with no command, asks for a picture to get)
+    """
+    parser = argparse.ArgumentParser(description="Tools for getting pictures of the sky")
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('benchmark', help="time fetching a view as nine requests and as one mosaic")
+
+    pack_parser = subparsers.add_parser('pack', help="download the tiles for a part of the sky into a pack file, for use with no network")
+    pack_parser.add_argument('output', help="the pack file (added to if it already exists)")
+    pack_parser.add_argument('--region', type=float, nargs=4, metavar=('RA_MIN', 'RA_MAX', 'DE_MIN', 'DE_MAX'),
+                             help="a region of the sky, RA in hours and DEC in degrees")
+    pack_parser.add_argument('--target', type=float, nargs=2, action='append', default=[], metavar=('RA', 'DE'),
+                             help="the view around an RA (hours) and DEC (degrees), can be given more than once")
+    pack_parser.add_argument('--planets', action='store_true', help="the views around the planets, the moon and the sun")
+    pack_parser.add_argument('--location', default='Greenwich', help="the site the planets are seen from")
+    pack_parser.add_argument('--time', help="when the planets are seen (\"YYYY-MM-DD HH:MM:SS\", now if not given)")
+    pack_parser.add_argument('--magnifications', type=float, nargs='+', default=[0], help="the magnifications to pack")
+    pack_parser.add_argument('--radius', type=int, default=1, help="tiles packed all round the middle of each view")
+    pack_parser.add_argument('--workers', type=int, default=PACK_WORKERS, help="tiles downloaded at once")
+
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        # The Pleiades
+        nine_time, mosaic_time = benchmark_fetch_modes(tools.from_hour_rep(3, 47, 24), tools.from_deg_rep(24, 7, 0))
+        print("Nine requests: {}s, one mosaic: {}s".format(round(nine_time, 2), round(mosaic_time, 2)))
+    elif args.command == 'pack':
+        pack_command(args)
+    else:
+        prompt_sky_picture()
+
 if __name__ == '__main__':
-    prompt_sky_picture()
+    main()
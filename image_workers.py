@@ -0,0 +1,168 @@
+'''Decoding and resizing of tiles in worker processes, so it doesn't hold the GIL the GUI needs'''
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PIL import Image
+
+from enhance import NO_ENHANCEMENT, enhance_image
+from sky_tile import SkyTile, pixels_to_image
+
+# Number of worker processes (0 to do everything in the calling thread instead)
+PROCESS_WORKERS = 3
+
+def _image_buffer(image):
+    """
+    Gets an image as its raw pixels (and what's needed to rebuild it), to pass between processes
+    """
+    return image.tobytes(), image.mode, image.size
+
+def _image_from_buffer(pixels, mode, size):
+    """
+    Rebuilds an image from its raw pixels
+    """
+    return Image.frombytes(mode, size, pixels)
+
+def _pixels_buffer(pixels):
+    """
+    Gets an array of pixels as raw bytes (and what's needed to rebuild it), to pass between processes
+    """
+    return np.ascontiguousarray(pixels).tobytes(), pixels.dtype.str, pixels.shape
+
+def _pixels_from_buffer(pixels, dtype, shape):
+    """
+    Rebuilds an array of pixels from its raw bytes, as a view onto them
+    """
+    return np.frombuffer(pixels, dtype).reshape(shape)
+
+def _tile_buffer(tile):
+    """
+    Gets a tile as raw bytes: its JPEG data if it has any, otherwise its raw pixels
+    """
+    if tile.data is not None:
+        return tile.data, None, None, None
+
+    return (None,) + _pixels_buffer(tile.pixels)
+
+def _tile_from_buffer(data, pixels, dtype, shape):
+    """
+    Rebuilds a tile from what _tile_buffer gave
+    """
+    if data is not None:
+        return SkyTile(data)
+
+    return SkyTile(pixels=_pixels_from_buffer(pixels, dtype, shape))
+
+def _display_in_worker(tile_buffer, display_size, settings):
+    """
+    Runs in a worker process, resizing and enhancing a tile for display
+    """
+    return _image_buffer(enhance_image(_tile_from_buffer(*tile_buffer).display(display_size), settings))
+
+def _decode_in_worker(data):
+    """
+    Runs in a worker process, decoding a tile at full resolution
+    """
+    return _pixels_buffer(SkyTile(data).pixels)
+
+class ImageWorkers:
+    """
+    A pool of processes that tiles are decoded and resized in, passing only raw byte buffers back and forth.
+    Processes are forked, so that the GUI script isn't imported again in each of them; where forking
+    isn't possible (or the pool breaks) the work is done in the calling thread instead
+    """
+    def __init__(self, workers=PROCESS_WORKERS):
+        """
+        Sets up the pool (the processes are only started when first needed, or by start())
+        """
+        self.workers = workers
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self.offloaded = 0
+        self.local = 0
+
+    def start(self):
+        """
+        Starts the worker processes now, best done before many threads are running
+        """
+        executor = self._get_executor()
+
+        if executor is not None:
+            executor.submit(int).result()
+
+    def _get_executor(self):
+        """
+        Gets the process pool, making it if needed (None if work can't be offloaded)
+        """
+        with self._lock:
+            if self._executor is None and self.workers > 0:
+                if 'fork' in multiprocessing.get_all_start_methods():
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+                else:
+                    self.workers = 0
+
+            return self._executor
+
+    def _run(self, function, *args):
+        """
+        Runs a function in a worker process, giving None if that isn't possible
+        """
+        executor = self._get_executor()
+
+        if executor is None:
+            return None
+
+        try:
+            result = executor.submit(function, *args).result()
+        except (BrokenProcessPool, RuntimeError) as error:
+            print("Image worker pool failed, working in-thread from now on: {}".format(error))
+
+            with self._lock:
+                self._executor = None
+                self.workers = 0
+
+            return None
+
+        self.offloaded += 1
+
+        return result
+
+    def display(self, tile, size, settings=NO_ENHANCEMENT):
+        """
+        Gets a tile resized for display (like SkyTile.display) and enhanced with some settings
+        """
+        result = self._run(_display_in_worker, _tile_buffer(tile), size, settings)
+
+        if result is None:
+            self.local += 1
+            return enhance_image(tile.display(size), settings)
+
+        return _image_from_buffer(*result)
+
+    def decode_pixels(self, tile):
+        """
+        Gets a tile's pixels at full resolution as an array (like SkyTile.pixels)
+        """
+        if tile.data is None:
+            return tile.pixels
+
+        result = self._run(_decode_in_worker, tile.data)
+
+        if result is None:
+            self.local += 1
+            return tile.pixels
+
+        return _pixels_from_buffer(*result)
+
+    def decode(self, tile):
+        """
+        Gets a tile decoded at full resolution (like SkyTile.image, but fully loaded)
+        """
+        return pixels_to_image(self.decode_pixels(tile))
+
+# The pool shared by everything that decodes tiles
+IMAGE_WORKERS = ImageWorkers()
@@ -0,0 +1,282 @@
+'''Exporting mosaics of any number of tiles, written to disk a row of tiles at a time'''
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from get_picture import get_sky_tile
+from image_workers import IMAGE_WORKERS
+from sky_grid import TILE_PIXELS, tile_key
+from sky_tile import image_to_pixels, pixels_to_image
+from tile_client import TileFetchError
+
+# Signature every PNG file starts with
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# zlib level the streamed PNGs are compressed with
+PNG_COMPRESSION_LEVEL = 6
+
+# Number of tiles fetched at once for an export
+EXPORT_WORKERS = 4
+
+# Most tiles a mosaic can have when it isn't a PNG (those are put together in memory, about 190KiB a tile)
+MAX_UNSTREAMED_TILES = 9
+
+class PNGStreamWriter:
+    """
+    Writes an 8-bit RGB PNG to an open file a band of rows at a time, so the whole image never has to be in memory
+    """
+    def __init__(self, fil, width, height):
+        """
+        Writes the header of a width x height PNG to a file opened for binary writing
+        """
+        self.fil = fil
+        self.width = width
+        self.height = height
+
+        self.rows_written = 0
+
+        self._compressor = zlib.compressobj(PNG_COMPRESSION_LEVEL)
+
+        fil.write(PNG_SIGNATURE)
+        # 8 bits per channel, truecolour, no interlacing
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type, data):
+        """
+        Writes a chunk (its length, type, data and CRC)
+        """
+        self.fil.write(struct.pack('>I', len(data)))
+        self.fil.write(chunk_type)
+        self.fil.write(data)
+        self.fil.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def write_rows(self, pixels):
+        """
+        Writes some whole rows of RGB pixels, given as a (rows x width x 3) array of bytes
+        """
+        if pixels.shape[1:] != (self.width, 3) or pixels.dtype != np.uint8:
+            raise ValueError("Only rows of {} RGB pixels can be written".format(self.width))
+
+        rows = pixels.shape[0]
+
+        if self.rows_written + rows > self.height:
+            raise ValueError("More rows written than the height of the image")
+
+        # every row starts with its filter type (0, none)
+        filtered = np.zeros((rows, 1 + self.width * 3), np.uint8)
+        filtered[:, 1:] = pixels.reshape(rows, -1)
+
+        data = self._compressor.compress(filtered)
+        if data:
+            self._write_chunk(b'IDAT', data)
+
+        self.rows_written += rows
+
+    def close(self):
+        """
+        Finishes the PNG off (every row must have been written), without closing the file
+        """
+        if self.rows_written != self.height:
+            raise ValueError("Only {} of the {} rows were written".format(self.rows_written, self.height))
+
+        self._write_chunk(b'IDAT', self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+
+def is_streamed(path):
+    """
+    Gets whether a mosaic saved to a path is streamed to disk (it's a PNG) rather than put together in memory
+    """
+    return path.lower().endswith('.png')
+
+class MosaicExport:
+    """
+    Exports a mosaic of columns x rows tiles centred on a shift on a background thread, getting the
+    tiles from a memory cache or the normal fetching (disk cache and mirrors) and writing each row of tiles
+    to disk as it's done. The tiles are only ever arrays, copied once into the row they belong in.
+    PNGs are streamed, so only a couple of rows of tiles are ever in memory;
+    other formats are put together in memory and saved at the end, so can only be up to MAX_UNSTREAMED_TILES
+    """
+    def __init__(self, base_ra, base_de, shiftx, shifty, magnification_level, columns, rows, path, memory_cache=None):
+        """
+        Sets up an export (start() starts it)
+        """
+        if columns * rows > MAX_UNSTREAMED_TILES and not is_streamed(path):
+            raise ValueError("Mosaics of more than {} tiles can only be saved as PNGs".format(MAX_UNSTREAMED_TILES))
+
+        self.base_ra = base_ra
+        self.base_de = base_de
+        self.shiftx = shiftx
+        self.shifty = shifty
+        self.magnification_level = magnification_level
+
+        self.columns = columns
+        self.rows = rows
+        self.path = path
+
+        self.memory_cache = memory_cache
+
+        self.tiles_done = 0
+        self.error = None
+
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+        # set when cancelled or failed, so the tiles still queued aren't fetched
+        self._stop = threading.Event()
+
+    @property
+    def total_tiles(self):
+        """
+        The number of tiles in the mosaic
+        """
+        return self.columns * self.rows
+
+    @property
+    def progress(self):
+        """
+        The fraction of the tiles done so far
+        """
+        return self.tiles_done / self.total_tiles
+
+    @property
+    def cancelled(self):
+        """
+        Whether the export has been cancelled
+        """
+        return self._cancelled.is_set()
+
+    @property
+    def finished(self):
+        """
+        Whether the export has stopped, because it's done, failed (error is set) or was cancelled
+        """
+        return self._finished.is_set()
+
+    def start(self):
+        """
+        Starts exporting on a background thread
+        """
+        export_thread = threading.Thread(None, self._export)
+        export_thread.setDaemon(True)
+        export_thread.start()
+
+    def cancel(self):
+        """
+        Stops the export as soon as possible, deleting anything written
+        """
+        self._cancelled.set()
+        self._stop.set()
+
+    def tile_shift(self, column, row):
+        """
+        Gets the shift of a tile in the mosaic (columns from the left and rows from the top)
+        """
+        # positive x shifts go east, which is to the left on the screen, and positive y shifts go up
+        return (self.shiftx + (self.columns // 2 - column) * TILE_PIXELS,
+                self.shifty + (self.rows // 2 - row) * TILE_PIXELS)
+
+    def _get_tile_pixels(self, column, row):
+        """
+        Gets the pixels of a tile of the mosaic at full resolution (runs on the fetch threads)
+        """
+        if self._stop.is_set():
+            return None
+
+        shiftx, shifty = self.tile_shift(column, row)
+
+        tile = None
+        if self.memory_cache is not None:
+            tile = self.memory_cache.get(tile_key(self.base_ra, self.base_de, shiftx, shifty, self.magnification_level))
+
+        if tile is None:
+            tile = get_sky_tile(self.base_ra, self.base_de, shiftx, shifty, self.magnification_level)
+
+        pixels = IMAGE_WORKERS.decode_pixels(tile)
+
+        if pixels.shape[:2] != (TILE_PIXELS, TILE_PIXELS):
+            pixels = image_to_pixels(pixels_to_image(pixels).resize((TILE_PIXELS, TILE_PIXELS)))
+
+        return pixels
+
+    def _rows_of_tiles(self, executor):
+        """
+        Yields each row of the mosaic as one (RGB) array, fetching the next row while the last is being written
+        """
+        def submit_row(row):
+            return [executor.submit(self._get_tile_pixels, column, row) for column in range(self.columns)]
+
+        pending = submit_row(0)
+
+        for row in range(self.rows):
+            futures = pending
+            pending = submit_row(row + 1) if row + 1 < self.rows else []
+
+            strip = np.zeros((TILE_PIXELS, self.columns * TILE_PIXELS, 3), np.uint8)
+
+            for column, future in enumerate(futures):
+                pixels = future.result()
+
+                if pixels is None:
+                    return
+
+                # greyscale tiles are spread across all three channels
+                if pixels.ndim == 2:
+                    pixels = pixels[:, :, np.newaxis]
+
+                strip[:, column * TILE_PIXELS:(column + 1) * TILE_PIXELS] = pixels[:, :, :3]
+                self.tiles_done += 1
+
+            yield strip
+
+    def _export(self):
+        """
+        Fetches, puts together and writes the mosaic (runs on the export thread)
+        """
+        streaming = is_streamed(self.path)
+        temp_path = self.path + ".part"
+
+        executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
+
+        try:
+            if streaming:
+                with open(temp_path, 'wb') as fil:
+                    writer = PNGStreamWriter(fil, self.columns * TILE_PIXELS, self.rows * TILE_PIXELS)
+
+                    for strip in self._rows_of_tiles(executor):
+                        writer.write_rows(strip)
+
+                    if not self._cancelled.is_set():
+                        writer.close()
+
+                if not self._cancelled.is_set():
+                    os.replace(temp_path, self.path)
+            else:
+                full_pixels = np.zeros((self.rows * TILE_PIXELS, self.columns * TILE_PIXELS, 3), np.uint8)
+
+                for row, strip in enumerate(self._rows_of_tiles(executor)):
+                    full_pixels[row * TILE_PIXELS:(row + 1) * TILE_PIXELS] = strip
+
+                if not self._cancelled.is_set():
+                    pixels_to_image(full_pixels).save(self.path)
+        except TileFetchError as error:
+            self.error = "A tile could not be downloaded ({})".format(error)
+        except (OSError, ValueError) as error:
+            self.error = "The image could not be saved ({})".format(error)
+        except Exception as error:
+            # anything else still has to be reported, or the export would look like it had worked
+            self.error = "The image could not be saved ({!r})".format(error)
+        finally:
+            self._stop.set()
+            executor.shutdown(wait=False)
+
+            if os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+            self._finished.set()
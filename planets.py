@@ -1,14 +1,81 @@
 import time
 import threading
-from queue import Queue, Full, Empty
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
+import numpy as np
+from numpy.polynomial import chebyshev
+from astropy import units as u
+from astropy.constants import c as speed_of_light
 from astropy.time import Time
-from astropy.coordinates import EarthLocation, get_body, solar_system_ephemeris, get_sun, get_moon
+from astropy.coordinates import (GCRS, ICRS, AltAz, CartesianRepresentation, EarthLocation, get_body,
+                                 get_body_barycentric, solar_system_ephemeris, get_sun, get_moon)
 
-# Queue to hold the planet locations
-PLANET_COORDINATES = Queue(1)
-PLANET_COORDINATES.put([])
+from single_flight import SingleFlight
+
+# A set of planet coordinates (read only, in the order of MAPPING_DICT) with what they were worked out for:
+# the location, the time of the latest update, the time each body was last updated for and whether the time is fixed
+PlanetSnapshot = namedtuple('PlanetSnapshot', ['version', 'coords', 'location', 'obstime', 'body_times', 'manual',
+                                               'computed_at'])
+
+class PlanetSnapshotStore:
+    """
+    Holds the latest planet coordinates for any number of readers. Reading never removes or waits for them,
+    each new set gets the next version number, and readers can wait for one newer than what they have
+    """
+    def __init__(self):
+        """
+        Sets up with no coordinates yet
+        """
+        self._condition = threading.Condition()
+        self._snapshot = None
+
+    @property
+    def version(self):
+        """
+        The version of the latest snapshot (0 before there is one)
+        """
+        snapshot = self._snapshot
+
+        return 0 if snapshot is None else snapshot.version
+
+    def latest(self):
+        """
+        Gets the latest snapshot, or None if there isn't one yet
+        """
+        return self._snapshot
+
+    def publish(self, coords, location, obstime, body_times, manual):
+        """
+        Makes new coordinates the latest snapshot, waking anyone waiting, and returns it
+        """
+        coords = np.array(coords)
+        coords.setflags(write=False)
+
+        with self._condition:
+            snapshot = PlanetSnapshot(self.version + 1, coords, location, obstime, tuple(body_times), manual, time.time())
+
+            self._snapshot = snapshot
+            self._condition.notify_all()
+
+        return snapshot
+
+    def wait(self, newer_than=0, timeout=None):
+        """
+        Waits for a snapshot with a version above newer_than (by default, any snapshot),
+        giving it or None if the timeout (in seconds) runs out first
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.version > newer_than, timeout)
+
+            snapshot = self._snapshot
+
+        if snapshot is None or snapshot.version <= newer_than:
+            return None
+
+        return snapshot
+
+# The latest planet locations
+PLANET_SNAPSHOTS = PlanetSnapshotStore()
 
 # Makes an ordered dictionary (to deal with linux) to store the values of the planets
 MAPPING_DICT = [
@@ -25,10 +92,126 @@ MAPPING_DICT = [
 ]
 MAPPING_DICT = OrderedDict(MAPPING_DICT)
 
+# The names astropy knows the bodies by, in the order of MAPPING_DICT
+BODY_NAMES = ['mercury', 'venus', 'mars', 'jupiter', 'saturn', 'uranus', 'neptune', 'pluto', 'moon', 'sun']
+
+# The JPL ephemeris the positions come from
+EPHEMERIS = 'de432s'
+
+# The light travel times are worked out again until they change by less than this
+LIGHT_TIME_TOLERANCE = 1e-8 * u.s
+
+# Hours covered by each interpolation table, starting a little before the time it was made for
+TABLE_HOURS = 24
+TABLE_LEAD_HOURS = 2
+
+# Each table is split into segments of this many hours, each with its own Chebyshev series of this degree
+SEGMENT_HOURS = 6
+CHEBYSHEV_DEGREE = 8
+
+# Number of interpolation tables kept (one per location)
+MAX_TABLES = 4
+
+# Number of times get_planet_tracks works out at once (which bounds the memory astropy needs)
+TRACK_CHUNK_TIMES = 2000
+
+def _apparent_positions(real_time, obsgeoloc):
+    """
+    Gets the barycentric (ICRS) positions of all the bodies as seen from an observer at obsgeoloc (GCRS),
+    each corrected for the time its light takes to get there, as one CartesianRepresentation
+    (of shape (bodies,) + the shape of real_time, so a whole array of times is done at once)
+    """
+    observer = get_body_barycentric('earth', real_time) + obsgeoloc
+
+    light_travel_times = np.zeros((len(BODY_NAMES),) + real_time.shape) * u.s
+    change = np.inf * u.s
+
+    while change > LIGHT_TIME_TOLERANCE:
+        emitted_times = real_time - light_travel_times
+
+        positions = [get_body_barycentric(name, emitted_times[index]) for index, name in enumerate(BODY_NAMES)]
+
+        x = u.Quantity([position.x for position in positions])
+        y = u.Quantity([position.y for position in positions])
+        z = u.Quantity([position.z for position in positions])
+
+        distances = np.sqrt((x - observer.x)**2 + (y - observer.y)**2 + (z - observer.z)**2)
+
+        new_light_travel_times = (distances / speed_of_light).to(u.s)
+        change = np.max(np.abs(new_light_travel_times - light_travel_times))
+        light_travel_times = new_light_travel_times
+
+    return CartesianRepresentation(x, y, z)
+
 def get_planet_coords(obstime, loc, manual=False):
+    """
+    Gets the coordinates of the planets (and the sun and pluto and the moon) as an array with a row of
+    (RA in hours, DEC in degrees) for each, in the order of MAPPING_DICT.
+    All the bodies go through the frame transformation together, as seen from the location
+    (so the sun is topocentric too, which moves it by well under 10 arcseconds)
+    """
+    if not manual:
+        real_time = Time(time.strftime("%Y-%m-%d %H:%M:%S"))
+    else:
+        real_time = Time(obstime)
+
+    real_location = EarthLocation.of_site(loc)
+
+    return _planet_coords_at(real_time, real_location)
+
+def _planet_coords_at(real_time, real_location, altaz=False):
+    """
+    Gets the array of planet coordinates (like get_planet_coords) at an astropy Time and EarthLocation,
+    with the (azimuth, altitude) in degrees after the RA and DEC if altaz is True.
+    For an array of times the rows of each body are in order of time, giving (bodies, times, 2 or 4)
+    """
+    obsgeoloc, obsgeovel = real_location.get_gcrs_posvel(real_time)
+
+    with solar_system_ephemeris.set(EPHEMERIS):
+        positions = _apparent_positions(real_time, obsgeoloc)
+
+    gcrs = ICRS(positions).transform_to(GCRS(obstime=real_time, obsgeoloc=obsgeoloc, obsgeovel=obsgeovel))
+
+    coords = [gcrs.ra.hour, gcrs.dec.degree]
+
+    if altaz:
+        horizontal = ICRS(positions).transform_to(AltAz(obstime=real_time, location=real_location))
+        coords += [horizontal.az.degree, horizontal.alt.degree]
+
+    return np.stack(coords, axis=-1)
+
+def get_planet_tracks(times, loc, altaz=False, path=None):
+    """
+    Gets the positions of every body from a location at each of an array of times (anything astropy's Time takes),
+    as a (times, bodies, 2) array of (RA in hours, DEC in degrees) in the order of MAPPING_DICT,
+    or (times, bodies, 4) with (azimuth, altitude) in degrees too if altaz is True.
+    The times are worked out TRACK_CHUNK_TIMES at a time; with a path each chunk goes straight into
+    a .npy file there, which is returned memory-mapped, so long ranges never have to fit in memory
+    """
+    real_times = Time(times).reshape(-1)
+    real_location = EarthLocation.of_site(loc)
+
+    shape = (len(real_times), len(BODY_NAMES), 4 if altaz else 2)
+
+    if path is None:
+        tracks = np.empty(shape)
+    else:
+        tracks = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+
+    for start in range(0, len(real_times), TRACK_CHUNK_TIMES):
+        chunk_times = real_times[start:start + TRACK_CHUNK_TIMES]
+
+        tracks[start:start + len(chunk_times)] = np.moveaxis(_planet_coords_at(chunk_times, real_location, altaz), 0, 1)
+
+    if path is not None:
+        tracks.flush()
+
+    return tracks
+
+def old_get_planet_coords(obstime, loc, manual=False):
     """
     Gets the coordinates of the planets (and the sun and pluto and the moon)
-    and return them in a list
+    and return them in a list (one body at a time, kept to time get_planet_coords against)
     """
     if not manual:
         real_time = Time(time.strftime("%Y-%m-%d %H:%M:%S"))
@@ -65,25 +248,196 @@ def get_planet_coords(obstime, loc, manual=False):
 
     return coordinates
 
-def constant_planet_update(fake=False, skip=False, screen=None):
+def benchmark_planet_coords(loc, rounds=5):
     """
-    Constantly gets the planet coordinates and updates the queue with them
+    Times getting the planet coordinates the old way (a body at a time) and the new way (all at once).
+    Returns the average seconds of each as (old, new)
     """
-    new_coords = get_planet_coords(screen.time, screen.location, screen.time_manual)
+    obstime = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    # the first call of each downloads or loads what it needs
+    old_get_planet_coords(obstime, loc, True)
+    get_planet_coords(obstime, loc, True)
+
+    start_time = time.time()
+    for _ in range(rounds):
+        old_get_planet_coords(obstime, loc, True)
+    old_time = (time.time() - start_time) / rounds
+
+    start_time = time.time()
+    for _ in range(rounds):
+        get_planet_coords(obstime, loc, True)
+    new_time = (time.time() - start_time) / rounds
+
+    return old_time, new_time
+
+class EphemerisTable:
+    """
+    The positions of all the bodies from a location over TABLE_HOURS, as a Chebyshev series per SEGMENT_HOURS
+    so that the position at any time in them is a cheap interpolation rather than a full calculation.
+    The positions are also worked out in between the points the series were fitted to,
+    and error_bound is the worst the interpolation got any of those (in arcseconds)
+    """
+    def __init__(self, start_time, loc):
+        """
+        Works out the table for a location (site name), starting at an astropy Time
+        """
+        self.start_time = start_time
+        self.location = loc
+        self.segments = TABLE_HOURS // SEGMENT_HOURS
+
+        # Chebyshev nodes (in order) fit the series best, and the interpolation is worst about halfway between them
+        nodes = np.sort(np.cos(np.pi * (np.arange(CHEBYSHEV_DEGREE + 1) + 0.5) / (CHEBYSHEV_DEGREE + 1)))
+        checks = (nodes[1:] + nodes[:-1]) / 2
+
+        points = np.concatenate((nodes, checks))
+        # (segments, points) hours from the start
+        hours = (np.arange(self.segments)[:, np.newaxis] + (points + 1) / 2) * SEGMENT_HOURS
+
+        real_location = EarthLocation.of_site(loc)
+        # (bodies, segments, points, 2)
+        coords = _planet_coords_at(start_time + hours * u.hour, real_location)
 
-    try:
-        PLANET_COORDINATES.put(new_coords, block=False)
-    except Full:
-        PLANET_COORDINATES.get()
-        PLANET_COORDINATES.put(new_coords)
+        # RAs are made continuous from the first point of each segment, so they don't jump back at 24 hours
+        first_ra = coords[:, :, :1, 0]
+        coords[:, :, :, 0] = first_ra + (coords[:, :, :, 0] - first_ra + 12) % 24 - 12
 
-    if not fake:
-        if not skip:
-            time.sleep(10)
+        fitted, checked = coords[:, :, :len(nodes)], coords[:, :, len(nodes):]
 
-        planet_update_thread = threading.Thread(None, lambda: constant_planet_update(screen=screen))
-        planet_update_thread.setDaemon(True)
-        planet_update_thread.start()
+        # chebfit wants the points first, so the series come out as (degree + 1, bodies, segments, 2)
+        series = chebyshev.chebfit(nodes, np.moveaxis(fitted, 2, 0).reshape(len(nodes), -1), CHEBYSHEV_DEGREE)
+        self._series = series.reshape((CHEBYSHEV_DEGREE + 1,) + fitted.shape[:2] + (2,))
+
+        interpolated = np.stack([self._evaluate(segment, checks) for segment in range(self.segments)], axis=1)
+        self.error_bound = np.max(_separation_arcseconds(interpolated, checked))
+
+    def _evaluate(self, segment, x, bodies=None):
+        """
+        Evaluates the series of a segment at points x (from -1 at its start to 1 at its end) for some bodies
+        (indices, or all of them if None), giving (bodies, points, 2) with the RAs back between 0 and 24
+        """
+        series = self._series[:, :, segment]
+
+        if bodies is not None:
+            series = series[:, bodies]
+
+        # comes out as (bodies, 2, points)
+        coords = np.moveaxis(chebyshev.chebval(x, series), -1, 1)
+
+        return np.stack((coords[..., 0] % 24, coords[..., 1]), axis=-1)
+
+    def hours_in(self, obstime):
+        """
+        Gets how many hours into the table an astropy Time is (None if the table doesn't cover it)
+        """
+        hours = (obstime - self.start_time).to_value(u.hour)
+
+        if not 0 <= hours <= self.segments * SEGMENT_HOURS:
+            return None
+
+        return hours
+
+    def coords_at(self, obstime, bodies=None):
+        """
+        Gets the coordinates of the bodies at an astropy Time the table covers (like get_planet_coords),
+        or only of some of them if given a list of their indices
+        """
+        hours = self.hours_in(obstime)
+
+        if hours is None:
+            raise ValueError("{} is not covered by the ephemeris table".format(obstime))
+
+        segment = min(int(hours // SEGMENT_HOURS), self.segments - 1)
+        x = 2 * (hours - segment * SEGMENT_HOURS) / SEGMENT_HOURS - 1
+
+        return self._evaluate(segment, np.array([x]), bodies)[:, 0]
+
+def _separation_arcseconds(coords, other_coords):
+    """
+    Gets the angles (in arcseconds) between two arrays of (RA in hours, DEC in degrees) coordinates
+    """
+    ra, dec = np.radians(coords[..., 0] * 15), np.radians(coords[..., 1])
+    other_ra, other_dec = np.radians(other_coords[..., 0] * 15), np.radians(other_coords[..., 1])
+
+    # haversine formula, which (unlike the cosine rule) stays accurate for tiny angles
+    haversine = np.sin((dec - other_dec) / 2)**2 + np.cos(dec) * np.cos(other_dec) * np.sin((ra - other_ra) / 2)**2
+
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))) * 3600
+
+class EphemerisTables:
+    """
+    The interpolation tables in use (the latest for each location), making a new one whenever a time
+    isn't covered. Threads asking for the same table at once share the one calculation
+    """
+    def __init__(self):
+        """
+        Sets up with no tables
+        """
+        self._lock = threading.Lock()
+
+        # location -> EphemerisTable, least recently used first
+        self._tables = OrderedDict()
+        self._flights = SingleFlight()
+
+        self.built = 0
+        self.hits = 0
+
+    def table_for(self, real_time, loc):
+        """
+        Gets a table covering an astropy Time from a location, making it if needed
+        """
+        with self._lock:
+            table = self._tables.get(loc)
+
+            if table is not None and table.hours_in(real_time) is not None:
+                self._tables.move_to_end(loc)
+                self.hits += 1
+                return table
+
+        start_time = real_time - TABLE_LEAD_HOURS * u.hour
+
+        # anything asked for while the table is being made goes into the same table
+        table = self._flights.do(loc, lambda: self._build(start_time, loc))
+
+        if table.hours_in(real_time) is None:
+            table = self._build(start_time, loc)
+
+        return table
+
+    def _build(self, start_time, loc):
+        """
+        Makes a table and keeps it as the one for its location
+        """
+        table = EphemerisTable(start_time, loc)
+
+        with self._lock:
+            self._tables[loc] = table
+            self._tables.move_to_end(loc)
+            self.built += 1
+
+            while len(self._tables) > MAX_TABLES:
+                self._tables.popitem(last=False)
+
+        return table
+
+# The interpolation tables shared by everything that wants planet positions
+EPHEMERIS_TABLES = EphemerisTables()
+
+def get_interpolated_planet_coords(obstime, loc, manual=False, bodies=None):
+    """
+    Gets the coordinates of the planets like get_planet_coords, but interpolated from a table
+    (only slow when the time or location needs a new table; the table's error_bound is the accuracy).
+    Only the bodies with the indices in bodies are interpolated (in that order) if it's given
+    """
+    if not manual:
+        real_time = Time(time.strftime("%Y-%m-%d %H:%M:%S"))
+    else:
+        real_time = Time(obstime)
+
+    return EPHEMERIS_TABLES.table_for(real_time, loc).coords_at(real_time, bodies)
 
 if __name__ == '__main__':
-    print(get_planet_coords('greenwich', time.strftime("%Y-%m-%d %H:%M:%S")))
+    print(get_planet_coords(time.strftime("%Y-%m-%d %H:%M:%S"), 'greenwich'))
+
+    old_time, new_time = benchmark_planet_coords('greenwich')
+    print("A body at a time: {}s, all at once: {}s".format(round(old_time, 3), round(new_time, 3)))
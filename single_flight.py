@@ -0,0 +1,74 @@
+'''Coalescing of identical calls that are in flight at the same time'''
+import threading
+
+class _Call:
+    """
+    A call in flight, which everyone asking for the same key waits on
+    """
+    def __init__(self):
+        """
+        Sets up a call that hasn't finished yet
+        """
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Makes concurrent calls with the same key share one run of the function:
+    the first caller runs it and everyone else waits for (and gets) its result or exception.
+    Nothing is kept once the call has finished, so it's not a cache
+    """
+    def __init__(self):
+        """
+        Sets up with nothing in flight
+        """
+        self._lock = threading.Lock()
+
+        # key -> _Call
+        self._calls = {}
+
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function):
+        """
+        Gets the result of function(), sharing it with any other caller with the same key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self):
+        """
+        Gets the number of calls running at the moment
+        """
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,190 @@
+'''The grid of tiles the sky is split into at each magnification'''
+import math
+from collections import OrderedDict
+
+# Size (x and y, in pixels) of each tile, which is also how far the view moves each step
+TILE_PIXELS = 256
+
+# Pixel offsets for the pixel shifts of the 3x3 view (in the order the tiles are displayed)
+VIEW_OFFSETS = [
+    (256, 256),  (0, 256),  (-256, 256),
+    (256, 0),    (0, 0),    (-256, 0),
+    (256, -256), (0, -256), (-256, -256)
+]
+
+# Number of tiles between anchor points, the bases that views are shifted from
+ANCHOR_SPACING = 8
+
+# Smallest cos(dec) used, so that the anchors near the poles don't get infinitely wide
+MIN_COS_DEC = 0.01
+
+def tile_angle(magnification_level):
+    """
+    Gets the angle (in degrees) across a tile at a magnification
+    """
+    return 1.25 * (0.75**magnification_level)
+
+def pixel_scale(magnification_level):
+    """
+    Gets the angle (in degrees) across a pixel at a magnification
+    """
+    return tile_angle(magnification_level) / TILE_PIXELS
+
+def _cos_dec(de):
+    """
+    Gets the cosine of a declination, limited so it never reaches 0
+    """
+    return max(math.cos(math.radians(de)), MIN_COS_DEC)
+
+def _anchor_de_step(magnification_level):
+    """
+    Gets the declination (in degrees) between rows of anchors
+    """
+    return ANCHOR_SPACING * tile_angle(magnification_level)
+
+def _ra_anchor_count(anchor_de, magnification_level):
+    """
+    Gets the number of anchors in the row at a declination (so they're about as far apart as the rows)
+    """
+    width_hours = _anchor_de_step(magnification_level) / 15 / _cos_dec(anchor_de)
+
+    return max(1, int(round(24 / width_hours)))
+
+def anchor_indices(ra, de, magnification_level):
+    """
+    Gets the (ra, dec) indices of the anchor nearest to an RA and DEC
+    """
+    de_step = _anchor_de_step(magnification_level)
+
+    de_index = int(round(de / de_step))
+    anchor_de = max(-90, min(90, de_index * de_step))
+
+    ra_count = _ra_anchor_count(anchor_de, magnification_level)
+    ra_index = int(round(ra / (24 / ra_count))) % ra_count
+
+    return ra_index, de_index
+
+def anchor_coordinates(ra_index, de_index, magnification_level):
+    """
+    Gets the RA and DEC of an anchor from its indices
+    """
+    anchor_de = max(-90, min(90, de_index * _anchor_de_step(magnification_level)))
+
+    ra_count = _ra_anchor_count(anchor_de, magnification_level)
+
+    return (ra_index % ra_count) * 24 / ra_count, anchor_de
+
+def _project(ra, de, anchor_ra, anchor_de):
+    """
+    Projects an RA and DEC onto the (gnomonic) tangent plane at an anchor, giving
+    x (east) and y (north) in degrees
+    """
+    ra_offset = math.radians((ra - anchor_ra) * 15)
+    de, anchor_de = math.radians(de), math.radians(anchor_de)
+
+    cos_c = math.sin(anchor_de) * math.sin(de) + math.cos(anchor_de) * math.cos(de) * math.cos(ra_offset)
+
+    x = math.cos(de) * math.sin(ra_offset) / cos_c
+    y = (math.cos(anchor_de) * math.sin(de) - math.sin(anchor_de) * math.cos(de) * math.cos(ra_offset)) / cos_c
+
+    return math.degrees(x), math.degrees(y)
+
+def _deproject(x, y, anchor_ra, anchor_de):
+    """
+    Gets the RA and DEC of a point (x east and y north, in degrees) on the tangent plane at an anchor
+    """
+    x, y = math.radians(x), math.radians(y)
+    anchor_de = math.radians(anchor_de)
+
+    rho = math.hypot(x, y)
+
+    if rho == 0:
+        return anchor_ra % 24, math.degrees(anchor_de)
+
+    c = math.atan(rho)
+
+    de = math.asin(math.cos(c) * math.sin(anchor_de) + y * math.sin(c) * math.cos(anchor_de) / rho)
+    ra_offset = math.atan2(x * math.sin(c), rho * math.cos(anchor_de) * math.cos(c) - y * math.sin(anchor_de) * math.sin(c))
+
+    return (anchor_ra + math.degrees(ra_offset) / 15) % 24, math.degrees(de)
+
+def snap_view(ra, de, magnification_level):
+    """
+    Gets the view on the tile grid nearest to an RA and DEC, as (anchor_ra, anchor_de, shiftx, shifty).
+    The RA and DEC end up within half a tile of the middle of the view.
+    Positive x shifts go east and positive y shifts go north (left and up on the screen, like the arrow keys)
+    """
+    anchor_ra, anchor_de = anchor_coordinates(*anchor_indices(ra, de, magnification_level), magnification_level)
+
+    pixels_x, pixels_y = sky_to_shift(ra, de, anchor_ra, anchor_de, magnification_level)
+
+    shiftx = int(round(pixels_x / TILE_PIXELS)) * TILE_PIXELS
+    shifty = int(round(pixels_y / TILE_PIXELS)) * TILE_PIXELS
+
+    return anchor_ra, anchor_de, shiftx, shifty
+
+def pan_view(anchor_ra, anchor_de, shiftx, shifty, move_x, move_y, magnification_level):
+    """
+    Gets the view (like snap_view) that moving a view by some pixels ends up at. A view moved into another anchor's cell
+    is moved onto that anchor, so that the tiles of any part of the sky always have the same keys however it was got to
+    (as they do in tile packs). Everything that guesses the keys of a view after a move has to go through this
+    """
+    shiftx += move_x
+    shifty += move_y
+
+    if move_x or move_y:
+        ra, de = view_centre(anchor_ra, anchor_de, shiftx, shifty, magnification_level)
+
+        if anchor_indices(ra, de, magnification_level) != anchor_indices(anchor_ra, anchor_de, magnification_level):
+            return snap_view(ra, de, magnification_level)
+
+    return anchor_ra, anchor_de, shiftx, shifty
+
+def snap_views_near(ra, de, magnification_level):
+    """
+    Gets every view (like snap_view) an RA and DEC could be in the middle of: the one on its nearest anchor,
+    and the ones on the anchors of any cells within half a tile of it (a view panned over a cell's edge
+    is moved onto that cell's anchor, which can leave its middle up to half a tile outside the cell)
+    """
+    half_de = tile_angle(magnification_level) / 2
+    half_ra = half_de / 15 / _cos_dec(de)
+
+    nearby = [(ra, de), (ra + half_ra, de), (ra - half_ra, de), (ra, min(90, de + half_de)), (ra, max(-90, de - half_de))]
+
+    views = []
+
+    for indices in OrderedDict.fromkeys(anchor_indices(near_ra % 24, near_de, magnification_level) for near_ra, near_de in nearby):
+        anchor_ra, anchor_de = anchor_coordinates(*indices, magnification_level)
+
+        pixels_x, pixels_y = sky_to_shift(ra, de, anchor_ra, anchor_de, magnification_level)
+
+        views.append((anchor_ra, anchor_de, int(round(pixels_x / TILE_PIXELS)) * TILE_PIXELS,
+                      int(round(pixels_y / TILE_PIXELS)) * TILE_PIXELS))
+
+    return views
+
+def sky_to_shift(ra, de, anchor_ra, anchor_de, magnification_level):
+    """
+    Gets the (not tile-aligned) pixel shift from an anchor that would put an RA and DEC in the middle of the view
+    """
+    scale = pixel_scale(magnification_level)
+
+    x, y = _project(ra, de, anchor_ra, anchor_de)
+
+    return x / scale, y / scale
+
+def view_centre(anchor_ra, anchor_de, shiftx, shifty, magnification_level):
+    """
+    Gets the RA and DEC in the middle of a view
+    """
+    scale = pixel_scale(magnification_level)
+
+    return _deproject(shiftx * scale, shifty * scale, anchor_ra, anchor_de)
+
+def tile_key(anchor_ra, anchor_de, shiftx, shifty, magnification_level):
+    """
+    Gets the key of a tile that is the same whichever view it is seen from
+    """
+    ra_index, de_index = anchor_indices(anchor_ra, anchor_de, magnification_level)
+
+    return (magnification_level, ra_index, de_index, shiftx, shifty)
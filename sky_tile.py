@@ -0,0 +1,79 @@
+'''A sky tile, kept as it was downloaded and only decoded as far as it's needed'''
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# How much smaller than the display size a reduced-scale decode may come out (it's resized up the rest of the way)
+DRAFT_TOLERANCE = 0.9
+
+def image_to_pixels(image):
+    """
+    Gets the pixels of an image as an array (height x width, with a third axis for multi-band images)
+    """
+    return np.asarray(image)
+
+def pixels_to_image(pixels):
+    """
+    Gets an image from an array of pixels (only done where PIL or Tk need one)
+    """
+    return Image.fromarray(pixels)
+
+class SkyTile:
+    """
+    A tile kept as its raw (JPEG) data, so that it can be decoded at a reduced scale for display
+    and only decoded at full resolution when something like saving actually needs it.
+    Tiles that were cut out of something bigger have no data and keep their pixels instead,
+    as an array that is usually a view into what they were cut out of (so cutting them out copies nothing)
+    """
+    def __init__(self, data=None, pixels=None):
+        """
+        Makes a tile from either its raw data or an array of its pixels
+        """
+        self.data = data
+        self._pixels = pixels
+
+    @property
+    def pixels(self):
+        """
+        The tile's pixels at full resolution as an array (decoded again each time for tiles with data)
+        """
+        if self._pixels is not None:
+            return self._pixels
+
+        return image_to_pixels(Image.open(BytesIO(self.data)))
+
+    @property
+    def image(self):
+        """
+        The tile decoded at full resolution (decoded again each time for tiles with data)
+        """
+        if self._pixels is not None:
+            return pixels_to_image(self._pixels)
+
+        return Image.open(BytesIO(self.data))
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes the tile takes up in memory
+        """
+        if self.data is not None:
+            return len(self.data)
+
+        return self._pixels.nbytes
+
+    def display(self, size):
+        """
+        Gets the tile resized for display, decoding JPEG data at the smallest scale
+        that is still close enough to the display size (JPEG draft mode)
+        """
+        if self.data is None:
+            return pixels_to_image(self._pixels).resize(size, Image.LANCZOS)
+
+        image = Image.open(BytesIO(self.data))
+
+        # only does anything for JPEGs, and only before the image is loaded
+        image.draft(image.mode, (int(size[0] * DRAFT_TOLERANCE), int(size[1] * DRAFT_TOLERANCE)))
+
+        return image.resize(size, Image.LANCZOS)
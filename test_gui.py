@@ -7,6 +7,11 @@ import tkinter as tk
 
 from astronomy_gui import pages
 from astronomy_gui.controller import CONTROLLER
+from image_workers import IMAGE_WORKERS
+
+# the decode/resize processes are forked first, while this is the only thread
+# (forking a process with other threads running can copy locks they hold into the children)
+IMAGE_WORKERS.start()
 
 if platform.system() == "Linux":
     from tools import setup_gpio
@@ -0,0 +1,479 @@
+'''Caches for the sky tiles downloaded from wikisky'''
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from enhance import NO_ENHANCEMENT
+from image_workers import IMAGE_WORKERS
+from sky_tile import SkyTile
+
+# Where the downloaded tiles are kept between runs
+DISK_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pistronomy", "tiles")
+
+# Maximum number of bytes the tiles on disk may take up
+DISK_CACHE_BUDGET = 256 * 1024 * 1024
+
+# Maximum number of bytes of tiles (and their display renditions) kept in memory
+MEMORY_CACHE_BUDGET = 64 * 1024 * 1024
+
+# Maximum number of bytes of compressed (cold) tiles kept in memory, 0 to not keep any
+COLD_CACHE_BUDGET = 16 * 1024 * 1024
+
+# zlib level the cold tiles are compressed with (fast rather than small)
+COLD_COMPRESSION_LEVEL = 1
+
+# Extension of the tile files in the cache directory
+TILE_EXTENSION = ".jpg"
+
+def tile_cache_key(survey, ra, de, x_shift, y_shift, angle, size=256):
+    """
+    Makes the key for a tile from its imgcut parameters, rounding the floats
+    so that the same part of the sky always gives the same key (size is only added for non-standard cutouts)
+    """
+    key = (survey, round(ra, 6), round(de, 6), int(x_shift), int(y_shift), round(angle, 6))
+
+    return key if size == 256 else key + (size,)
+
+class DiskTileCache:
+    """
+    A cache of raw tile data on disk, with a size budget and least recently used eviction.
+    What is already on disk is read in the background, started by start() or the first use
+    (not on import, so that no threads are running when the image worker processes are forked)
+    """
+    def __init__(self, directory=DISK_CACHE_DIR, budget=DISK_CACHE_BUDGET):
+        """
+        Sets up the cache (without reading what's on disk yet)
+        """
+        self.directory = directory
+        self.budget = budget
+
+        # file name -> size in bytes, oldest first
+        self._index = OrderedDict()
+        self._size = 0
+
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._index_thread = None
+
+    def start(self):
+        """
+        Starts reading what is already on disk in the background (does nothing if it's been started)
+        """
+        with self._lock:
+            if self._index_thread is not None:
+                return
+
+            self._index_thread = threading.Thread(None, self._load_index)
+            self._index_thread.setDaemon(True)
+            self._index_thread.start()
+
+    def _wait_ready(self):
+        """
+        Waits for what is already on disk to have been read (starting the reading if needed)
+        """
+        self.start()
+        self._ready.wait()
+
+    def _load_index(self):
+        """
+        Reads the tiles already on disk into the index, ordered by when they were last used
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(TILE_EXTENSION):
+                    continue
+
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        except OSError:
+            entries = []
+
+        entries.sort()
+
+        with self._lock:
+            for _, name, size in entries:
+                self._index[name] = size
+                self._size += size
+
+            self._evict()
+
+        self._ready.set()
+
+    def _file_name(self, key):
+        """
+        Gets the name of the file a tile is stored in
+        """
+        return hashlib.sha1(repr(key).encode()).hexdigest() + TILE_EXTENSION
+
+    def __contains__(self, key):
+        """
+        Checks if a tile is on disk without waiting (False until the index has been read)
+        """
+        if not self._ready.is_set():
+            self.start()
+            return False
+
+        with self._lock:
+            return self._file_name(key) in self._index
+
+    def get(self, key):
+        """
+        Gets the raw data of a tile, or None if it isn't cached.
+        Waits for the index to be read, so shouldn't be called from the Tk thread
+        """
+        self._wait_ready()
+
+        name = self._file_name(key)
+
+        with self._lock:
+            if name not in self._index:
+                return None
+            self._index.move_to_end(name)
+
+        path = os.path.join(self.directory, name)
+
+        try:
+            with open(path, 'rb') as fil:
+                data = fil.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(name)
+            return None
+
+        return data
+
+    def put(self, key, data):
+        """
+        Stores the raw data of a tile, evicting the least recently used tiles if over budget
+        """
+        self._wait_ready()
+
+        name = self._file_name(key)
+        path = os.path.join(self.directory, name)
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+
+        try:
+            with open(temp_path, 'wb') as fil:
+                fil.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        with self._lock:
+            self._forget(name)
+            self._index[name] = len(data)
+            self._size += len(data)
+
+            self._evict()
+
+    def discard(self, key):
+        """
+        Deletes a tile if it's cached
+        """
+        self._wait_ready()
+
+        name = self._file_name(key)
+
+        with self._lock:
+            self._forget(name)
+
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def set_budget(self, budget):
+        """
+        Changes the size budget of the cache (in bytes)
+        """
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        """
+        Deletes every tile in the cache
+        """
+        self._wait_ready()
+
+        with self._lock:
+            budget = self.budget
+            self.budget = 0
+            self._evict()
+            self.budget = budget
+
+    def stats(self):
+        """
+        Gets the number of tiles and bytes in the cache
+        """
+        with self._lock:
+            return len(self._index), self._size
+
+    def _forget(self, name):
+        """
+        Removes a file from the index (lock must be held)
+        """
+        size = self._index.pop(name, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self):
+        """
+        Deletes the least recently used tiles until under budget (lock must be held)
+        """
+        while self._index and self._size > self.budget:
+            name, size = self._index.popitem(last=False)
+            self._size -= size
+
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+def image_size(image):
+    """
+    Gets the number of bytes a decoded image takes up
+    """
+    return image.width * image.height * len(image.getbands())
+
+class TileMemoryCache:
+    """
+    A dict-like cache of SkyTiles with a byte budget and least recently used eviction.
+    Tiles pushed out of the budget are kept compressed (cold) until they fall out of the cold budget too,
+    and the tiles around the current view can be kept hot whatever happens.
+    Hot tiles also keep the resized versions they have been displayed at
+    """
+    def __init__(self, budget=MEMORY_CACHE_BUDGET, cold_budget=COLD_CACHE_BUDGET):
+        """
+        Sets up an empty cache
+        """
+        self.budget = budget
+        self.cold_budget = cold_budget
+
+        # key -> SkyTile, oldest first
+        self._hot = OrderedDict()
+        self._hot_size = 0
+
+        # key -> (JPEG data, None, None) or (compressed pixels, dtype, shape), oldest first
+        self._cold = OrderedDict()
+        self._cold_size = 0
+
+        # key -> {(size, enhance settings): resized image}, counted in the hot size
+        self._renditions = {}
+
+        self._working_set = set()
+
+        self._lock = threading.RLock()
+
+        self.rendition_hits = 0
+        self.hits = 0
+        self.cold_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        """
+        Checks if a tile is cached (hot or cold)
+        """
+        with self._lock:
+            return key in self._hot or key in self._cold
+
+    def __len__(self):
+        """
+        Gets the number of tiles cached
+        """
+        with self._lock:
+            return len(self._hot) + len(self._cold)
+
+    def __getitem__(self, key):
+        """
+        Gets a tile, decompressing it if it was cold
+        """
+        tile = self.get(key)
+
+        if tile is None:
+            raise KeyError(key)
+
+        return tile
+
+    def __setitem__(self, key, tile):
+        """
+        Adds a tile as the most recently used
+        """
+        with self._lock:
+            self._remove(key)
+
+            self._hot[key] = tile
+            self._hot_size += tile.nbytes
+
+            self._shrink()
+
+    def get(self, key, default=None):
+        """
+        Gets a tile (marking it as recently used), or default if it isn't cached
+        """
+        with self._lock:
+            if key in self._hot:
+                self.hits += 1
+                self._hot.move_to_end(key)
+                return self._hot[key]
+
+            if key not in self._cold:
+                self.misses += 1
+                return default
+
+            self.cold_hits += 1
+            data, dtype, shape = self._cold.pop(key)
+            self._cold_size -= len(data)
+
+        if dtype is None:
+            tile = SkyTile(data)
+        else:
+            # a view straight onto the decompressed bytes
+            tile = SkyTile(pixels=np.frombuffer(zlib.decompress(data), dtype).reshape(shape))
+
+        self[key] = tile
+
+        return tile
+
+    def discard(self, key):
+        """
+        Removes a tile (and its resized versions) if it's cached
+        """
+        with self._lock:
+            self._remove(key)
+
+    def cached_rendition(self, key, size, settings=NO_ENHANCEMENT):
+        """
+        Gets a tile resized for display and enhanced if that's already been done, otherwise None
+        (never resizes anything, so it's quick enough for the Tk thread)
+        """
+        with self._lock:
+            image = self._renditions.get(key, {}).get((size, settings))
+
+            if image is not None:
+                self.rendition_hits += 1
+
+            return image
+
+    def rendition(self, key, size, source=None, settings=NO_ENHANCEMENT):
+        """
+        Gets a tile resized for display and enhanced, resizing it (or the SkyTile source, if the tile isn't cached)
+        only the first time for each size and settings. Returns None if there's nothing to resize.
+        Resizing waits on a worker process, so this shouldn't be called from the Tk thread
+        """
+        image = self.cached_rendition(key, size, settings)
+
+        if image is not None:
+            return image
+
+        if source is None:
+            source = self.get(key)
+
+            if source is None:
+                return None
+
+        # resized in a worker process, if there are any
+        image = IMAGE_WORKERS.display(source, size, settings)
+
+        with self._lock:
+            if key in self._hot:
+                renditions = self._renditions.setdefault(key, {})
+
+                # another thread may have resized the same tile meanwhile, and it's only counted once
+                if (size, settings) in renditions:
+                    return renditions[(size, settings)]
+
+                renditions[(size, settings)] = image
+                self._hot_size += image_size(image)
+
+                self._shrink()
+
+        return image
+
+    def keep_hot(self, keys):
+        """
+        Sets the working set of tiles that are never compressed or evicted
+        """
+        with self._lock:
+            self._working_set = set(keys)
+
+    def clear(self):
+        """
+        Removes every tile
+        """
+        with self._lock:
+            self._hot.clear()
+            self._cold.clear()
+            self._renditions.clear()
+            self._hot_size = 0
+            self._cold_size = 0
+
+    def stats(self):
+        """
+        Gets the counters and sizes of the cache (for monitoring)
+        """
+        with self._lock:
+            return {'rendition_hits': self.rendition_hits, 'hits': self.hits, 'cold_hits': self.cold_hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hot_tiles': len(self._hot), 'hot_bytes': self._hot_size,
+                    'cold_tiles': len(self._cold), 'cold_bytes': self._cold_size}
+
+    def _remove(self, key):
+        """
+        Removes a tile if it's there (lock must be held)
+        """
+        if key in self._hot:
+            self._hot_size -= self._hot.pop(key).nbytes
+            self._drop_renditions(key)
+        elif key in self._cold:
+            self._cold_size -= len(self._cold.pop(key)[0])
+
+    def _drop_renditions(self, key):
+        """
+        Removes the resized versions of a tile (lock must be held)
+        """
+        for image in self._renditions.pop(key, {}).values():
+            self._hot_size -= image_size(image)
+
+    def _shrink(self):
+        """
+        Compresses or evicts the least recently used tiles until within budget (lock must be held)
+        """
+        for key in list(self._hot):
+            if self._hot_size <= self.budget:
+                break
+
+            if key in self._working_set:
+                continue
+
+            tile = self._hot.pop(key)
+            self._hot_size -= tile.nbytes
+            self._drop_renditions(key)
+
+            if self.cold_budget:
+                if tile.data is not None:
+                    # already compressed
+                    self._cold[key] = (tile.data, None, None)
+                else:
+                    pixels = tile.pixels
+                    self._cold[key] = (zlib.compress(np.ascontiguousarray(pixels), COLD_COMPRESSION_LEVEL), pixels.dtype, pixels.shape)
+
+                self._cold_size += len(self._cold[key][0])
+            else:
+                self.evictions += 1
+
+        while self._cold and self._cold_size > self.cold_budget:
+            _, (data, _, _) = self._cold.popitem(last=False)
+            self._cold_size -= len(data)
+            self.evictions += 1
+
+# The cache shared by everything that gets tiles
+DISK_TILE_CACHE = DiskTileCache()
@@ -0,0 +1,275 @@
+'''Client for downloading sky tiles from the wikisky mirrors'''
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# The imgcut urls of all the wikisky mirrors
+MIRRORS = ['http://server{}.wikisky.org/imgcut'.format(number) for number in range(1, 10)]
+
+# seconds to wait for a mirror before also asking another one (until it has been measured)
+HEDGE_DELAY = 0.35
+
+# seconds before a single request is given up on (until the mirror has been measured)
+REQUEST_TIMEOUT = 1.0
+
+# limits for the timeouts worked out from the measured round trip times
+MIN_TIMEOUT = 0.3
+MAX_TIMEOUT = 5.0
+
+# the timeout is this many times the TIMEOUT_PERCENTILE of the recent round trip times
+TIMEOUT_PERCENTILE = 0.9
+TIMEOUT_FACTOR = 2.0
+
+# number of recent round trip times kept for each mirror
+RTT_WINDOW = 20
+
+# errors in a row before a mirror is put in cooldown, and how long the first cooldown lasts (doubles each time)
+COOLDOWN_ERRORS = 3
+COOLDOWN_TIME = 30
+
+# chance of trying a random healthy mirror instead of the fastest, to keep the statistics fresh
+EXPLORE_CHANCE = 0.1
+
+# maximum number of requests sent for one tile before giving up
+MAX_ATTEMPTS = 12
+
+# The outcome of a successful tile fetch
+FetchResult = namedtuple('FetchResult', ['content', 'mirror', 'attempts', 'hedged', 'elapsed'])
+
+class TileFetchError(Exception):
+    """
+    Raised when a tile could not be downloaded from any of the mirrors
+    """
+    def __init__(self, attempts, elapsed, last_error=None):
+        super().__init__("Tile could not be downloaded after {} attempts ({}s), last error: {}".format(attempts, round(elapsed, 2), last_error))
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.last_error = last_error
+
+class MirrorStats:
+    """
+    Keeps rolling round trip times and errors for each mirror, to rank them,
+    work out their timeouts and put failing ones in a cooldown
+    """
+    def __init__(self, mirrors):
+        """
+        Sets up empty statistics for every mirror
+        """
+        self._lock = threading.Lock()
+
+        self._rtts = {mirror: deque(maxlen=RTT_WINDOW) for mirror in mirrors}
+        self._errors_in_row = {mirror: 0 for mirror in mirrors}
+        self._cooldowns = {mirror: 0 for mirror in mirrors}
+        self._cooldown_until = {mirror: 0 for mirror in mirrors}
+
+    def _percentile(self, mirror, percentile):
+        """
+        Gets a percentile of the recent round trip times of a mirror (None if it hasn't been measured)
+        """
+        rtts = sorted(self._rtts[mirror])
+
+        if not rtts:
+            return None
+
+        return rtts[min(len(rtts) - 1, int(percentile * len(rtts)))]
+
+    def record_success(self, mirror, rtt):
+        """
+        Records a successful request to a mirror
+        """
+        with self._lock:
+            self._rtts[mirror].append(rtt)
+            self._errors_in_row[mirror] = 0
+            self._cooldowns[mirror] = 0
+
+    def record_error(self, mirror):
+        """
+        Records a failed request to a mirror, cooling it down if it keeps failing
+        """
+        with self._lock:
+            self._errors_in_row[mirror] += 1
+
+            if self._errors_in_row[mirror] >= COOLDOWN_ERRORS:
+                self._cooldown_until[mirror] = time.time() + COOLDOWN_TIME * 2**self._cooldowns[mirror]
+                self._cooldowns[mirror] += 1
+                self._errors_in_row[mirror] = 0
+
+    def timeout_for(self, mirror):
+        """
+        Gets the timeout for a request to a mirror from its recent round trip times
+        """
+        with self._lock:
+            rtt = self._percentile(mirror, TIMEOUT_PERCENTILE)
+
+        if rtt is None:
+            return REQUEST_TIMEOUT
+
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, rtt * TIMEOUT_FACTOR))
+
+    def hedge_delay_for(self, mirror):
+        """
+        Gets how long to wait for a mirror before asking another one as well
+        """
+        with self._lock:
+            rtt = self._percentile(mirror, TIMEOUT_PERCENTILE)
+
+        if rtt is None:
+            return HEDGE_DELAY
+
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT / 2, rtt * 1.2))
+
+    def ranked(self, exclude=()):
+        """
+        Gets the mirrors in the order they should be tried: healthy ones fastest first
+        (unmeasured ones count as fast so they get tried), then ones in cooldown
+        """
+        now = time.time()
+
+        with self._lock:
+            healthy = []
+            cooling = []
+
+            for mirror in self._rtts:
+                if mirror in exclude:
+                    continue
+
+                if self._cooldown_until[mirror] > now:
+                    cooling.append((self._cooldown_until[mirror], mirror))
+                else:
+                    median = self._percentile(mirror, 0.5)
+                    healthy.append((0 if median is None else median, random.random(), mirror))
+
+        healthy.sort()
+        cooling.sort()
+
+        ranking = [mirror for _, _, mirror in healthy]
+
+        if len(ranking) > 1 and random.random() < EXPLORE_CHANCE:
+            ranking.insert(0, ranking.pop(random.randrange(1, len(ranking))))
+
+        return ranking + [mirror for _, mirror in cooling]
+
+    def status(self):
+        """
+        Gets the median round trip time, timeout and cooldown left of every mirror (for monitoring)
+        """
+        now = time.time()
+
+        with self._lock:
+            mirrors = list(self._rtts)
+            medians = {mirror: self._percentile(mirror, 0.5) for mirror in mirrors}
+            cooldowns = {mirror: max(0, self._cooldown_until[mirror] - now) for mirror in mirrors}
+
+        return {mirror: {'median_rtt': medians[mirror],
+                         'timeout': self.timeout_for(mirror),
+                         'cooldown_left': cooldowns[mirror]}
+                for mirror in mirrors}
+
+class TileClient:
+    """
+    Downloads tiles over persistent sessions (one per mirror) from the fastest healthy
+    mirrors, sending a hedged second request to another mirror when the first one is slow
+    """
+    def __init__(self, mirrors=MIRRORS, max_attempts=MAX_ATTEMPTS):
+        """
+        Sets up the sessions, the mirror statistics and the threads the requests are sent from
+        """
+        self.mirrors = list(mirrors)
+        self.max_attempts = max_attempts
+
+        self.stats = MirrorStats(self.mirrors)
+
+        self._sessions = {}
+        for mirror in self.mirrors:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            self._sessions[mirror] = session
+
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(self.mirrors))
+
+    def _choose_mirror(self, busy):
+        """
+        Chooses the best mirror to send a request to, avoiding ones that are already being waited on
+        """
+        ranking = self.stats.ranked(exclude=busy)
+
+        return ranking[0] if ranking else self.stats.ranked()[0]
+
+    def _request(self, mirror, params):
+        """
+        Sends a single request to a mirror, recording how it went
+        """
+        start_time = time.time()
+
+        try:
+            response = self._sessions[mirror].get(mirror, params=params, timeout=self.stats.timeout_for(mirror))
+        except requests.exceptions.RequestException:
+            self.stats.record_error(mirror)
+            raise
+
+        if response.ok:
+            self.stats.record_success(mirror, time.time() - start_time)
+        else:
+            self.stats.record_error(mirror)
+
+        return response
+
+    def fetch(self, params):
+        """
+        Gets the raw tile data for some imgcut params, returning a FetchResult
+        or raising TileFetchError once every attempt has failed
+        """
+        start_time = time.time()
+
+        attempts = 0
+        hedged = False
+        last_error = None
+
+        # future -> mirror it was sent to
+        pending = {}
+
+        while True:
+            if not pending:
+                if attempts >= self.max_attempts:
+                    raise TileFetchError(attempts, time.time() - start_time, last_error)
+
+                mirror = self._choose_mirror(pending.values())
+                pending[self._executor.submit(self._request, mirror, params)] = mirror
+                attempts += 1
+
+            hedge_delay = min(self.stats.hedge_delay_for(mirror) for mirror in pending.values())
+
+            done, _ = wait(list(pending), timeout=hedge_delay, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # the request is slow, so ask another mirror as well
+                if len(pending) < 2 and attempts < self.max_attempts:
+                    mirror = self._choose_mirror(pending.values())
+                    pending[self._executor.submit(self._request, mirror, params)] = mirror
+                    attempts += 1
+                    hedged = True
+                continue
+
+            for future in done:
+                mirror = pending.pop(future)
+
+                try:
+                    response = future.result()
+                except requests.exceptions.RequestException as error:
+                    last_error = error
+                    continue
+
+                if not response.ok:
+                    last_error = "HTTP {} from {}".format(response.status_code, mirror)
+                    continue
+
+                # nothing to do with the slower request, it finishes in the background
+                return FetchResult(response.content, mirror, attempts, hedged, time.time() - start_time)
+
+# The client shared by everything that downloads tiles
+TILE_CLIENT = TileClient()
@@ -0,0 +1,269 @@
+'''Fetching of the sky tiles for the view and the area around it'''
+import itertools
+import threading
+from collections import deque, namedtuple
+from queue import PriorityQueue
+
+from get_picture import get_sky_mosaic, get_sky_tile
+from sky_grid import VIEW_OFFSETS, pan_view, tile_key
+
+# Moves of the view's shift (in pixels) of one step in each direction, whose views are prefetched
+PREFETCH_MOVES = [(x, y) for x in (-256, 0, 256) for y in (-256, 0, 256) if x or y]
+
+# Number of recent moves used to guess where the view is going next
+MOVE_HISTORY = 4
+
+# Number of threads fetching tiles (the pool never grows past this, however fast the view moves)
+FETCH_WORKERS = 4
+
+# Weight of the newest timing in the running average of each fetch mode
+MODE_TIMING_WEIGHT = 0.3
+
+# Every this many batches the slower fetch mode is tried again, in case the link has changed
+MODE_EXPLORE_EVERY = 10
+
+# Ways of fetching a whole 3x3 view
+NINE_REQUESTS = 'nine'
+MOSAIC = 'mosaic'
+
+# Priorities of the different tiles (lowest first)
+CENTRE_PRIORITY = 0
+VISIBLE_PRIORITY = 1
+PREFETCH_PRIORITY = 2
+
+class TileJob(namedtuple('TileJob', ['base_ra', 'base_de', 'shiftx', 'shifty', 'magnification'])):
+    """
+    The parameters of get_sky_tile for one tile
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """
+        The key the tile is cached under
+        """
+        return tile_key(self.base_ra, self.base_de, self.shiftx, self.shifty, self.magnification)
+
+class MosaicJob(TileJob):
+    """
+    The parameters of get_sky_mosaic for a whole 3x3 view (the shift is the middle tile's)
+    """
+    __slots__ = ()
+
+    def tile_jobs(self):
+        """
+        Gets the jobs of the 9 tiles the mosaic is sliced into (in the order of VIEW_OFFSETS)
+        """
+        return [TileJob(self.base_ra, self.base_de, self.shiftx + offset_x, self.shifty + offset_y, self.magnification)
+                for offset_x, offset_y in VIEW_OFFSETS]
+
+class FetchModeSelector:
+    """
+    Keeps running averages of how long a whole view takes to fetch as nine requests
+    and as one mosaic, to choose the faster one for the current link
+    """
+    def __init__(self):
+        """
+        Sets up with no timings (both modes get tried first)
+        """
+        self.timings = {NINE_REQUESTS: None, MOSAIC: None}
+        self._batches = 0
+
+    def record(self, mode, seconds):
+        """
+        Records how long a whole view took to fetch with a mode
+        """
+        if self.timings[mode] is None:
+            self.timings[mode] = seconds
+        else:
+            self.timings[mode] += MODE_TIMING_WEIGHT * (seconds - self.timings[mode])
+
+    def choose(self):
+        """
+        Chooses the mode to fetch the next whole view with
+        """
+        self._batches += 1
+
+        for mode, timing in self.timings.items():
+            if timing is None:
+                return mode
+
+        faster, slower = sorted(self.timings, key=self.timings.get)
+
+        return slower if self._batches % MODE_EXPLORE_EVERY == 0 else faster
+
+class TileFetchEngine:
+    """
+    Fetches tiles on a bounded pool of threads, in priority order.
+    Every request is tagged with the view generation it was made for: when the view moves on,
+    visible requests from the generation before are demoted to prefetches (so they still warm the cache)
+    and anything older is dropped
+    """
+    def __init__(self, on_tile, workers=FETCH_WORKERS):
+        """
+        Sets up the worker threads, on_tile(generation, slot, job, tile) is called from them
+        with every SkyTile fetched (tile is None if it couldn't be downloaded)
+        """
+        self.on_tile = on_tile
+
+        self._jobs = PriorityQueue()
+        self._counter = itertools.count()
+
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        self.mode_selector = FetchModeSelector()
+
+        for _ in range(workers):
+            worker = threading.Thread(None, self._work)
+            worker.setDaemon(True)
+            worker.start()
+
+    @property
+    def generation(self):
+        """
+        The generation of the current view
+        """
+        return self._generation
+
+    def new_generation(self):
+        """
+        Starts a new view generation, superseding every request made before it
+        """
+        with self._lock:
+            self._generation += 1
+            return self._generation
+
+    def submit(self, job, priority, slot=None):
+        """
+        Requests a tile for the current generation, slot is where it goes on screen (None for prefetches)
+        """
+        self._jobs.put((priority, next(self._counter), self._generation, slot, job))
+
+    def _work(self):
+        """
+        Fetches the best queued tile, skipping superseded ones
+        """
+        while True:
+            priority, _, generation, slot, job = self._jobs.get()
+
+            if generation != self._generation:
+                if priority < PREFETCH_PRIORITY and generation == self._generation - 1 and not isinstance(job, MosaicJob):
+                    # no longer visible, but likely to be wanted again soon
+                    self.submit(job, PREFETCH_PRIORITY)
+                continue
+
+            # nothing a job does may kill the worker, or its queue would never be emptied
+            try:
+                if isinstance(job, MosaicJob):
+                    self._fetch_mosaic(generation, job)
+                else:
+                    self._fetch_tile(generation, slot, job)
+            except Exception as error:
+                print("Fetching {} failed: {!r}".format(job, error))
+
+    def _fetch_tile(self, generation, slot, job):
+        """
+        Fetches a single tile
+        """
+        try:
+            tile = get_sky_tile(*job)
+        except Exception as error:
+            print("Fetching {} failed: {!r}".format(job, error))
+            tile = None
+
+        self._deliver(generation, slot, job, tile)
+
+    def _deliver(self, generation, slot, job, tile):
+        """
+        Hands a tile to on_tile, reporting it as not downloaded (None) if on_tile can't handle it
+        (such as data that isn't an image)
+        """
+        if tile is not None:
+            try:
+                self.on_tile(generation, slot, job, tile)
+                return
+            except Exception as error:
+                print("Tile {} could not be used: {!r}".format(job, error))
+
+        self.on_tile(generation, slot, job, None)
+
+    def _fetch_mosaic(self, generation, job):
+        """
+        Fetches a whole view as one mosaic, falling back to nine requests if that fails
+        """
+        try:
+            tiles = get_sky_mosaic(*job)
+        except Exception as error:
+            print("Fetching {} failed: {!r}".format(job, error))
+
+            for slot, tile_job in enumerate(job.tile_jobs()):
+                priority = CENTRE_PRIORITY if VIEW_OFFSETS[slot] == (0, 0) else VISIBLE_PRIORITY
+                self._jobs.put((priority, next(self._counter), generation, slot, tile_job))
+            return
+
+        for slot, (tile_job, tile) in enumerate(zip(job.tile_jobs(), tiles)):
+            self._deliver(generation, slot, tile_job, tile)
+
+def view_jobs(base_ra, base_de, shiftx, shifty, magnification):
+    """
+    Gets the jobs of the 9 tiles of a view (in the order of VIEW_OFFSETS)
+    """
+    return MosaicJob(base_ra, base_de, shiftx, shifty, magnification).tile_jobs()
+
+def ring_jobs(base_ra, base_de, shiftx, shifty, magnification):
+    """
+    Gets the tiles that a move of one step from a view would bring into view, as (offset, job) with the offset
+    being roughly the tile's shift from the view's middle square. The jobs are those of the view the move
+    actually ends up at (see pan_view), so they have the keys the screen asks for after it
+    """
+    seen = set(job.key for job in view_jobs(base_ra, base_de, shiftx, shifty, magnification))
+    ring = []
+
+    for move_x, move_y in PREFETCH_MOVES:
+        view = pan_view(base_ra, base_de, shiftx, shifty, move_x, move_y, magnification)
+
+        for (offset_x, offset_y), job in zip(VIEW_OFFSETS, view_jobs(*view, magnification)):
+            if job.key not in seen:
+                seen.add(job.key)
+                ring.append(((move_x + offset_x, move_y + offset_y), job))
+
+    return ring
+
+class TilePrefetcher:
+    """
+    Warms the caches with the tiles a move of one step from the current view would show (see ring_jobs)
+    at prefetch priority, fetching the tiles in the direction of recent movement first
+    """
+    def __init__(self, engine):
+        """
+        Sets up the prefetcher to queue its tiles on a fetch engine
+        """
+        self.engine = engine
+
+        self._moves = deque(maxlen=MOVE_HISTORY)
+
+    def record_move(self, shiftx, shifty):
+        """
+        Records a move of the view, to bias prefetching in that direction
+        """
+        if shiftx or shifty:
+            self._moves.append((shiftx, shifty))
+
+    def prefetch(self, base_ra, base_de, shiftx, shifty, magnification, skip=()):
+        """
+        Queues the ring around a view for the current generation,
+        skipping any tile whose key is in skip as those are already cached
+        """
+        move_x = sum(move[0] for move in self._moves)
+        move_y = sum(move[1] for move in self._moves)
+
+        # tiles in the direction of movement go first, and tiles nearer the middle of their edge before the corners
+        ring = sorted(ring_jobs(base_ra, base_de, shiftx, shifty, magnification),
+                      key=lambda item: -(item[0][0] * move_x + item[0][1] * move_y) + abs(item[0][0]) * abs(item[0][1]) / 512)
+
+        for _, job in ring:
+            if job.key in skip:
+                continue
+
+            self.engine.submit(job, PREFETCH_PRIORITY)
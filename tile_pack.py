@@ -0,0 +1,179 @@
+'''Packs of tiles in a single indexed file, for using the screen with no network'''
+import json
+import mmap
+import os
+import struct
+import threading
+
+# The first bytes of every pack file
+PACK_MAGIC = b'PISTPAK1'
+
+# The last bytes of a finished pack file, after the offset of its index
+INDEX_MAGIC = b'PAKINDEX'
+
+# Each record is the length of its key and data, then the key and the data
+RECORD_HEADER = struct.Struct('>II')
+
+# The footer is the offset of the index, then INDEX_MAGIC
+FOOTER = struct.Struct('>Q8s')
+
+def _key_name(key):
+    """
+    Gets the name a tile key is stored under in a pack
+    """
+    return repr(key)
+
+def _read_index(fil, size):
+    """
+    Reads the index of a pack file, as (name -> (offset, length), where the records end).
+    Unfinished packs have no index, so their records are read one by one (a record cut off part way is ignored)
+    """
+    if size >= len(PACK_MAGIC) + FOOTER.size:
+        fil.seek(size - FOOTER.size)
+        index_offset, magic = FOOTER.unpack(fil.read(FOOTER.size))
+
+        if magic == INDEX_MAGIC and len(PACK_MAGIC) <= index_offset <= size - FOOTER.size:
+            fil.seek(index_offset)
+            index = json.loads(fil.read(size - FOOTER.size - index_offset).decode())
+
+            return {name: tuple(location) for name, location in index.items()}, index_offset
+
+    index = {}
+    offset = len(PACK_MAGIC)
+
+    fil.seek(offset)
+
+    while offset + RECORD_HEADER.size <= size:
+        key_length, data_length = RECORD_HEADER.unpack(fil.read(RECORD_HEADER.size))
+
+        end = offset + RECORD_HEADER.size + key_length + data_length
+        if end > size:
+            break
+
+        name = fil.read(key_length).decode()
+        index[name] = (offset + RECORD_HEADER.size + key_length, data_length)
+
+        fil.seek(data_length, os.SEEK_CUR)
+        offset = end
+
+    return index, offset
+
+class TilePackWriter:
+    """
+    Writes tiles into a pack file, carrying on from whatever an earlier (possibly interrupted)
+    run already wrote. Tiles can be added from any thread
+    """
+    def __init__(self, path):
+        """
+        Opens (or starts) a pack file to add tiles to
+        """
+        self.path = path
+
+        self._lock = threading.Lock()
+
+        if os.path.exists(path) and os.path.getsize(path) >= len(PACK_MAGIC):
+            self._file = open(path, 'r+b')
+
+            if self._file.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                self._file.close()
+                raise ValueError("{} is not a tile pack".format(path))
+
+            self._index, end = _read_index(self._file, os.path.getsize(path))
+
+            # drops the old index (and anything cut off), it's written again when closing
+            self._file.truncate(end)
+            self._file.seek(end)
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(PACK_MAGIC)
+            self._index = {}
+
+    def __contains__(self, key):
+        """
+        Checks if a tile is already in the pack
+        """
+        with self._lock:
+            return _key_name(key) in self._index
+
+    def __len__(self):
+        """
+        Gets the number of tiles in the pack
+        """
+        with self._lock:
+            return len(self._index)
+
+    def add(self, key, data):
+        """
+        Adds the raw data of a tile (flushed straight away, so it's kept even if the run is stopped)
+        """
+        name = _key_name(key).encode()
+
+        with self._lock:
+            offset = self._file.tell()
+
+            self._file.write(RECORD_HEADER.pack(len(name), len(data)))
+            self._file.write(name)
+            self._file.write(data)
+            self._file.flush()
+
+            self._index[name.decode()] = (offset + RECORD_HEADER.size + len(name), len(data))
+
+    def close(self):
+        """
+        Writes the index and closes the pack
+        """
+        with self._lock:
+            index_offset = self._file.tell()
+
+            self._file.write(json.dumps(self._index).encode())
+            self._file.write(FOOTER.pack(index_offset, INDEX_MAGIC))
+            self._file.close()
+
+class TilePack:
+    """
+    A pack file opened for reading, memory-mapped so tiles are read straight out of it
+    """
+    def __init__(self, path):
+        """
+        Opens a pack file and reads its index
+        """
+        self.path = path
+
+        with open(path, 'rb') as fil:
+            if fil.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError("{} is not a tile pack".format(path))
+
+            self._index, _ = _read_index(fil, os.path.getsize(path))
+
+            self._map = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, key):
+        """
+        Checks if a tile is in the pack
+        """
+        return _key_name(key) in self._index
+
+    def __len__(self):
+        """
+        Gets the number of tiles in the pack
+        """
+        return len(self._index)
+
+    def get(self, key):
+        """
+        Gets the raw data of a tile, or None if it isn't in the pack
+        """
+        location = self._index.get(_key_name(key))
+
+        if location is None:
+            return None
+
+        offset, length = location
+
+        return self._map[offset:offset + length]
+
+    def close(self):
+        """
+        Closes the pack
+        """
+        self._map.close()
@@ -0,0 +1,106 @@
+'''Stand-ins for the tiles of one magnification, made from the tiles cached at the others'''
+import math
+
+from PIL import Image
+
+from enhance import NO_ENHANCEMENT
+from image_workers import IMAGE_WORKERS
+from sky_grid import TILE_PIXELS, pixel_scale, sky_to_shift, tile_key, view_centre
+
+# Furthest apart (as a ratio of scales) two magnifications can be for one to stand in for the other
+MAX_SCALE_RATIO = 4
+
+class TilePyramid:
+    """
+    The cached tiles across all the magnification levels. It remembers the anchor last used at each
+    magnification, so that the tiles cached at one level can be found again (and scaled) for another
+    """
+    def __init__(self, cache):
+        """
+        Sets up the pyramid over a TileMemoryCache
+        """
+        self.cache = cache
+
+        # magnification -> (anchor_ra, anchor_de)
+        self.anchors = {}
+
+    def record_view(self, anchor_ra, anchor_de, magnification):
+        """
+        Records the anchor of a view, so its tiles can stand in at other magnifications
+        """
+        self.anchors[magnification] = (anchor_ra, anchor_de)
+
+    def placeholder(self, job, size, settings=NO_ENHANCEMENT):
+        """
+        Makes a stand-in (of a display size, enhanced with settings) for a tile out of the cached tiles at the nearest
+        other magnification, or gives None if nothing near enough is cached.
+        Resizing waits on the worker processes, so this runs off the Tk thread (while record_view goes on in it)
+        """
+        ra, de = view_centre(job.base_ra, job.base_de, job.shiftx, job.shifty, job.magnification)
+
+        # copied in one go, as the Tk thread can record a view at any time
+        anchors = dict(self.anchors)
+
+        for magnification in sorted(anchors, key=lambda level: abs(level - job.magnification)):
+            if magnification == job.magnification:
+                continue
+
+            # pixels at the other magnification per pixel of the tile
+            ratio = pixel_scale(job.magnification) / pixel_scale(magnification)
+
+            if not 1 / MAX_SCALE_RATIO <= ratio <= MAX_SCALE_RATIO:
+                continue
+
+            image = self._compose(ra, de, ratio, anchors[magnification], magnification, size, settings)
+
+            if image is not None:
+                return image
+
+        return None
+
+    def _compose(self, ra, de, ratio, anchor, magnification, size, settings):
+        """
+        Pastes together the cached tiles at a magnification (seen from an anchor) that cover a tile centred on an RA and DEC
+        """
+        anchor_ra, anchor_de = anchor
+
+        centre_x, centre_y = sky_to_shift(ra, de, anchor_ra, anchor_de, magnification)
+
+        # on screen, a tile shifted by (x, y) sits at (-x, -y) as the shifts go east and north
+        half = TILE_PIXELS * ratio / 2
+        left = -centre_x - half
+        top = -centre_y - half
+
+        # display pixels per pixel at the other magnification
+        factor = size[0] / (2 * half)
+        tile_size = max(1, int(round(TILE_PIXELS * factor)))
+
+        image = None
+
+        first_x = int(math.floor((left + TILE_PIXELS / 2) / TILE_PIXELS))
+        last_x = int(math.floor((left + 2 * half + TILE_PIXELS / 2) / TILE_PIXELS))
+        first_y = int(math.floor((top + TILE_PIXELS / 2) / TILE_PIXELS))
+        last_y = int(math.floor((top + 2 * half + TILE_PIXELS / 2) / TILE_PIXELS))
+
+        for column in range(first_x, last_x + 1):
+            for row in range(first_y, last_y + 1):
+                key = tile_key(anchor_ra, anchor_de, -column * TILE_PIXELS, -row * TILE_PIXELS, magnification)
+
+                if key not in self.cache:
+                    continue
+
+                tile = self.cache.get(key)
+                if tile is None:
+                    continue
+
+                tile_image = IMAGE_WORKERS.display(tile, (tile_size, tile_size), settings)
+
+                if image is None:
+                    image = Image.new(tile_image.mode, size)
+
+                paste_x = int(round((column * TILE_PIXELS - TILE_PIXELS / 2 - left) * factor))
+                paste_y = int(round((row * TILE_PIXELS - TILE_PIXELS / 2 - top) * factor))
+
+                image.paste(tile_image, (paste_x, paste_y))
+
+        return image